@@ -0,0 +1,275 @@
+#####################################################################
+# Aldo Vargas
+#
+#
+# Purpose:
+#	Benchmarks for rpi-mw.
+#	- Decode time per frame of every handler, comparing the struct
+#	  based decoders of rpi-mw.py against the hex string decoders
+#	  (littleEndian and twosComp) still used by rpi-mw-legacy.py.
+#	- Loop rate, request to sample latency and CPU per sample of the
+#	  acquisition loop for every combination of drone flags, against
+#	  the simulated board of rpi-mw-sim.py running on a pty.
+#
+#	Usage: python rpi-mw-bench.py [--duration 1] [--output results.json]
+#
+########################################################################
+
+
+import sys			# for user input
+import os			# for locating the scripts and cpu times
+import imp			# for loading the scripts as modules
+import timeit		# for timing the decoders
+import time			# for wall time
+import json			# for the results
+import platform		# for describing the machine
+import itertools	# for the combinations of flags
+import subprocess	# for running the simulator
+import collections	# for the request queues
+import argparse		# for the command line
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+mw = imp.load_source('rpimw', os.path.join(here, 'rpi-mw.py'))
+legacy = imp.load_source('rpimw_legacy', os.path.join(here, 'rpi-mw-legacy.py'))
+
+
+# handler name, MSP name, raw values on the wire, legacy globals to check
+HANDLERS = [
+	('ATTITUDE', 'MSP_ATTITUDE', (-123, 45, 270), ['angx', 'angy', 'heading']),
+	('RC', 'MSP_RC', (1500, 1480, 1520, 1100, 1000, 1000, 2000, 2000), ['roll', 'pitch', 'yaw', 'throttle']),
+	('MOTORS', 'MSP_MOTOR', (1150, 1160, 1170, 1180, 0, 0, 0, 0), ['m1', 'm2', 'm3', 'm4']),
+	('RAW', 'MSP_RAW_IMU', (-3, -18, 515, 0, 1, -1, -50, -194, 465), ['ax', 'ay', 'az', 'gx', 'gy', 'gz', 'magx', 'magy', 'magz']),
+	('ALTITUDE', 'MSP_ALTITUDE', (-1234, 7), ['altitude']),
+]
+
+
+#############################################################
+# responseFrame(name, values)
+#	receives: MSP name and raw values
+#	returns:  a complete $M> response frame as sent by the MW
+#############################################################
+def responseFrame(name, values):
+	codec = mw.MSP_CODECS_BY_NAME[name]
+	payload = codec.struct.pack(*values)
+	checksum = len(payload) ^ codec.code
+	for c in payload:
+		checksum ^= ord(c)
+	return '$M>' + chr(len(payload)) + chr(codec.code) + payload + chr(checksum)
+
+
+#############################################################
+# MemoryPort(frame)
+#	receives: a frame
+#	function: serial port that has the frame ready every time it
+#		is read, to time receiveData without a board
+#############################################################
+class MemoryPort(object):
+	def __init__(self, frame):
+		self.frame = frame
+
+	def inWaiting(self):
+		return len(self.frame)
+
+	def read(self, size=1):
+		return self.frame
+
+
+#############################################################
+# benchDecode(number)
+#	receives: how many times each handler is called
+#	outputs:  time per frame for both decoders and the speedup
+#	returns:  list of results
+#############################################################
+def benchDecode(number):
+	results = []
+	print "%-12s %12s %12s %8s" % ("handler", "hex (us)", "struct (us)", "speedup")
+	for handler, name, values, fields in HANDLERS:
+		msp = responseFrame(name, values)
+		old = getattr(legacy, handler)
+		new = getattr(mw, handler)
+		old(msp)
+		record = new(msp)
+		for field in fields:
+			if abs(getattr(legacy, field) - getattr(record, field)) > 1e-9:
+				print "%s: %s mismatch (%s != %s)" % (handler, field, getattr(legacy, field), getattr(record, field))
+		t_old = min(timeit.repeat(lambda: old(msp), number=number, repeat=3))/number*1e6
+		t_new = min(timeit.repeat(lambda: new(msp), number=number, repeat=3))/number*1e6
+		print "%-12s %12.2f %12.2f %7.1fx" % (handler, t_old, t_new, t_old/t_new)
+		results.append({'handler': handler, 'hex_us': t_old, 'struct_us': t_new})
+	# receiveData, parser and decoder together, one frame per call
+	saved = mw.ser
+	mw.ser = MemoryPort(responseFrame('MSP_RAW_IMU', HANDLERS[3][2]))
+	mw.parser = mw.MSPParser()
+	t_new = min(timeit.repeat(mw.receiveData, number=number, repeat=3))/number*1e6
+	mw.ser = saved
+	print "%-12s %12s %12.2f" % ("receiveData", "-", t_new)
+	results.append({'handler': 'receiveData', 'hex_us': None, 'struct_us': t_new})
+	return results
+
+
+#############################################################
+# TimedPort(port, timeout)
+#	receives: serial port and how old a request can be
+#	function: remembers when every request was written, so the
+#		store can tell how long each answer took
+#############################################################
+class TimedPort(object):
+	def __init__(self, port, timeout=mw.timeSweep):
+		self.port = port
+		self.timeout = int(timeout*1e9)
+		self.parser = mw.MSPParser('<')
+		self.sent = collections.defaultdict(collections.deque)
+
+	def write(self, data):
+		now = mw.monotonicNs()
+		self.parser.feed(data)
+		for code, payload in self.parser:
+			self.sent[code].append(now)
+		return self.port.write(data)
+
+	# Time of the oldest request of code still waiting for its answer
+	def requested(self, code, stamp):
+		sent = self.sent[code]
+		while sent and stamp - sent[0] > self.timeout:
+			sent.popleft()	# lost
+		if sent:
+			return sent.popleft()
+		return None
+
+	def read(self, size=1):
+		return self.port.read(size)
+
+	def inWaiting(self):
+		return self.port.inWaiting()
+
+	def fileno(self):
+		return self.port.fileno()
+
+
+#############################################################
+# TimedStore(port)
+#	receives: TimedPort
+#	function: TelemetryStore that also keeps the time between
+#		every request and the publication of its answer
+#############################################################
+class TimedStore(mw.TelemetryStore):
+	def __init__(self, port):
+		mw.TelemetryStore.__init__(self)
+		self.port = port
+		self.latencies = []
+
+	def publish(self, code, record, raw, stamp):
+		sent = self.port.requested(code, stamp)
+		if sent is not None:
+			self.latencies.append(stamp-sent)
+		mw.TelemetryStore.publish(self, code, record, raw, stamp)
+
+
+#############################################################
+# percentiles(values)
+#	returns:  p50, p90, p99 and max of the values
+#############################################################
+def percentiles(values):
+	if not values:
+		return dict(p50=None, p90=None, p99=None, max=None)
+	values = sorted(values)
+	pick = lambda p: values[min(len(values)-1, int(p*len(values)))]
+	return dict(p50=pick(0.5), p90=pick(0.9), p99=pick(0.99), max=values[-1])
+
+
+#############################################################
+# benchLoop(port, names, duration, pipelined)
+#	receives: opened serial port, MSP names to poll, seconds to
+#		run and if the requests are pipelined
+#	function: runs the acquisition loop (event loop, serial link
+#		and a sink that counts samples) against the port
+#	returns:  loop rate, latency percentiles (ms) and cpu per
+#		sample (us)
+#############################################################
+def benchLoop(port, names, duration, pipelined=True):
+	timed = TimedPort(port)
+	store = TimedStore(timed)
+	loop = mw.EventLoop()
+	link = mw.SerialLink(timed, store, names, pipelined)
+	samples = [0]
+	def sink():
+		samples[0] += 1
+	def poll():
+		loop.callLater(link.tick(), poll)
+	link.onSweep = sink
+	loop.addReader(timed, link.onReadable)
+	loop.callLater(0, poll)
+	loop.callLater(duration, loop.stop)
+	cpu = os.times()
+	start = time.time()
+	loop.run()
+	wall = time.time()-start
+	cpu = sum(os.times()[:2]) - sum(cpu[:2])
+	time.sleep(2*mw.timeSweep)	# let the last answers arrive and drop them
+	port.read(port.inWaiting())
+	latency = percentiles(store.latencies)
+	for key in latency:
+		if latency[key] is not None:
+			latency[key] /= 1e6
+	return {
+		'messages': names,
+		'pipelined': pipelined,
+		'samples': samples[0],
+		'rate_hz': samples[0]/wall,
+		'latency_ms': latency,
+		'cpu_us_per_sample': cpu/max(1, samples[0])*1e6,
+		'parser_errors': link.parser.errors}
+
+
+#############################################################
+# startSimulator(args)
+#	receives: extra arguments for rpi-mw-sim.py
+#	returns:  the simulator process and the port it opened
+#############################################################
+def startSimulator(args):
+	sim = subprocess.Popen([sys.executable, os.path.join(here, 'rpi-mw-sim.py')]+args, stdout=subprocess.PIPE)
+	line = sim.stdout.readline()
+	return sim, line.split()[-1]
+
+
+#-----------------------------------------------------------------------
+if __name__=="__main__":
+	options = argparse.ArgumentParser(description="Benchmarks for rpi-mw")
+	options.add_argument("--number", type=int, default=20000, help="decodes per handler")
+	options.add_argument("--duration", type=float, default=1.0, help="seconds per loop run")
+	options.add_argument("--decode-only", action="store_true", help="only time the decoders")
+	options.add_argument("--sim", default="", help="extra arguments for rpi-mw-sim.py, like '--latency 1'")
+	options.add_argument("--output", default=None, help="write the results to this JSON file")
+	args = options.parse_args()
+
+	results = {
+		'python': platform.python_version(),
+		'machine': platform.platform(),
+		'time': time.time(),
+		'decode': benchDecode(args.number),
+		'loop': []}
+
+	if not args.decode_only:
+		sim, port = startSimulator(args.sim.split())
+		try:
+			mw.ser.port = port
+			mw.ser.open()
+			print
+			print "%-28s %5s %9s %9s %9s %9s" % ("messages", "pipe", "rate (Hz)", "p50 (ms)", "p99 (ms)", "cpu (us)")
+			flags = [name for flag, name in mw.DRONE_MESSAGES]
+			for n in range(1, len(flags)+1):
+				for names in itertools.combinations(flags, n):
+					for pipelined in (True, False):
+						result = benchLoop(mw.ser, list(names), args.duration, pipelined)
+						results['loop'].append(result)
+						short = "+".join([flag for flag, name in mw.DRONE_MESSAGES if name in names])
+						print "%-28s %5s %9.1f %9.2f %9.2f %9.1f" % (short, "yes" if pipelined else "no", result['rate_hz'], result['latency_ms']['p50'] or 0, result['latency_ms']['p99'] or 0, result['cpu_us_per_sample'])
+			mw.ser.close()
+		finally:
+			sim.terminate()
+
+	if args.output:
+		out = open(args.output, "w")
+		json.dump(results, out, indent=1)
+		out.close()
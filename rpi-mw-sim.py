@@ -0,0 +1,197 @@
+#####################################################################
+# Aldo Vargas
+#
+#
+# Purpose:
+#	Simulates a MultiWii board on a pseudo terminal, so rpi-mw.py can
+#	be tested and loaded without hardware. Answers every command of
+#	CMD2CODE with synthetic data, paced like a real serial link, and
+#	can inject corrupted checksums, dropped bytes and split frames.
+#	Like MultiWii 2.3 it can send the gyro as 0 while it calibrates.
+#
+#	Usage: python rpi-mw-sim.py [--link /tmp/ttyMW] [--corrupt 0.01] ...
+#	then point ser.port in rpi-mw.py to the port it prints.
+#
+########################################################################
+
+
+import sys			# for user input
+import os			# for the pseudo terminal
+import imp			# for loading rpi-mw.py as a module
+import pty			# for the pseudo terminal
+import tty			# for raw mode
+import time			# for the pacing
+import math			# for the synthetic data
+import random		# for noise and faults
+import select		# for waiting on the pseudo terminal
+import threading	# for running the simulator next to the tests
+import argparse		# for the command line
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+mw = imp.load_source('rpimw', os.path.join(here, 'rpi-mw.py'))
+
+
+#############################################################
+# syntheticValues(name, t, rng)
+#	receives: MSP name, seconds since the simulator started and
+#		a random generator
+#	returns:  raw values (as on the wire, repeated groups one
+#		after the other) of a flying multicopter for that message,
+#		or None if there is no model for it
+#############################################################
+def syntheticValues(name, t, rng):
+	if name == 'MSP_ATTITUDE':
+		return (int(150*math.sin(t)), int(100*math.cos(0.7*t)), int(10*t) % 360 - 5)
+	if name == 'MSP_RC':
+		return (1500+int(200*math.sin(t)), 1500+int(150*math.cos(0.7*t)), 1500, 1400+int(100*math.sin(0.2*t)), 1000, 1000, 2000, 2000)
+	if name == 'MSP_MOTOR':
+		base = 1400+int(100*math.sin(0.2*t))
+		return tuple([base+rng.randint(-20, 20) for i in range(4)]+[0]*4)
+	if name == 'MSP_RAW_IMU':
+		noise = lambda a: rng.randint(-a, a)
+		return (noise(3), noise(3)-18, 512+noise(4), noise(2), noise(2), noise(2), -50+noise(1), -194+noise(1), 465+noise(1))
+	if name == 'MSP_ALTITUDE':
+		return (int(150+100*math.sin(0.2*t)), int(20*math.cos(0.2*t)))
+	if name == 'MSP_IDENT':
+		return (230, 3, 0, 0)
+	if name == 'MSP_STATUS':
+		return (2800+rng.randint(0, 50), 0, 0x1F, 0, 0)
+	if name == 'MSP_ANALOG':
+		return (120-int(t/60) % 20, int(t*2), 0, 100+rng.randint(0, 20))
+	if name == 'MSP_RAW_GPS':
+		return (1, 9, 521234567+int(100*math.sin(0.1*t)), -15000000+int(100*math.cos(0.1*t)), 50, 150, int(10*t) % 3600)
+	if name == 'MSP_COMP_GPS':
+		return (12, int(10*t) % 360 - 180, 1)
+	if name == 'MSP_PID':
+		return (33, 30, 23, 33, 30, 23, 68, 45, 0, 64, 25, 24, 14, 20, 0, 64, 25, 24, 14, 20, 0, 0, 0, 0, 34, 14, 53, 90, 10, 100)
+	if name == 'MSP_BOX':
+		return (0x0001, 0x0002, 0x0004, 0x0000)
+	if name == 'MSP_BOXIDS':
+		return (0, 1, 2, 3)
+	if name == 'MSP_BOXNAMES':
+		return ('ARM;ANGLE;HORIZON;BARO;',)
+	if name == 'MSP_PIDNAMES':
+		return ('ROLL;PITCH;YAW;ALT;Pos;PosR;NavR;LEVEL;MAG;VEL;',)
+	return None
+
+
+#############################################################
+# Simulator(baudrate, latency, corrupt, drop, split, seed, calibration)
+#	receives: baud rate to emulate, processing time of the board
+#		in seconds, the probability of each fault, the seed and
+#		the seconds the gyro calibrates after the start
+#	function: opens a pseudo terminal and answers every MSP
+#		request written to it until stop() is called. port is
+#		the path to give to ser.port.
+#############################################################
+class Simulator(threading.Thread):
+	def __init__(self, baudrate=115200, latency=0.0005, corrupt=0.0, drop=0.0, split=0.0, seed=None, calibration=0.0):
+		threading.Thread.__init__(self, name="MultiWii simulator")
+		self.daemon = True
+		self.baudrate = baudrate
+		self.latency = latency
+		self.corrupt = corrupt
+		self.drop = drop
+		self.split = split
+		self.calibration = calibration
+		self.rng = random.Random(seed)
+		self.master, slave = pty.openpty()
+		tty.setraw(slave)
+		self.slave = slave
+		self.port = os.ttyname(slave)
+		self.parser = mw.MSPParser('<')
+		self.settings = {}	# payloads written by the set commands, by the code that reads them
+		self.requests = 0
+		self.running = False
+
+	# Complete answer to a request, payload is the data of the request
+	def answer(self, code, t, payload=''):
+		name = mw.CODE2CMD.get(code)
+		values = syntheticValues(name, t, self.rng)
+		if name == 'MSP_RAW_IMU' and t < self.calibration:
+			values = values[:3]+(0, 0, 0)+values[6:]	# gyro zeroed while calibrating
+		codec = mw.MSP_CODECS.get(code)
+		if name is not None and name.startswith('MSP_SET_') and 'MSP_'+name[8:] in mw.CMD2CODE:
+			self.settings[mw.CMD2CODE['MSP_'+name[8:]]] = str(bytearray(payload))	# read back by the get command
+		if codec is None or not codec.responseFormat:
+			payload = ''	# set commands are answered with no data
+		elif code in self.settings:
+			payload = self.settings[code]
+		elif values is not None:
+			payload = codec.pack(values)
+		else:
+			payload = codec.pack(codec.zero)
+		frame = bytearray('$M>'+chr(len(payload))+chr(code)+payload+'\x00')
+		frame[-1] = mw.xorChecksum(frame, 3, len(frame)-1)
+		return str(frame)
+
+	# Writes a frame as the board would, paced at the baud rate
+	def send(self, frame):
+		rng = self.rng
+		if self.corrupt and rng.random() < self.corrupt:
+			frame = frame[:-1]+chr(ord(frame[-1]) ^ 0xFF)
+		if self.drop and rng.random() < self.drop:
+			i = rng.randrange(len(frame))
+			frame = frame[:i]+frame[i+1:]
+		chunks = [frame]
+		if self.split and rng.random() < self.split and len(frame) > 1:
+			i = rng.randrange(1, len(frame))
+			chunks = [frame[:i], frame[i:]]
+		for chunk in chunks:
+			os.write(self.master, chunk)
+			time.sleep(len(chunk)*10.0/self.baudrate)
+
+	def run(self):
+		start = time.time()
+		self.running = True
+		while self.running:
+			if not select.select([self.master], [], [], 0.1)[0]:
+				continue
+			try:
+				data = os.read(self.master, 4096)
+			except OSError:
+				break
+			self.parser.feed(data)
+			for code, payload in self.parser:
+				self.requests += 1
+				if self.latency:
+					time.sleep(self.latency)
+				self.send(self.answer(code, time.time()-start, payload))
+
+	def stop(self):
+		self.running = False
+		self.join()
+		os.close(self.master)
+		os.close(self.slave)
+
+
+#-----------------------------------------------------------------------
+if __name__=="__main__":
+	options = argparse.ArgumentParser(description="Simulated MultiWii board on a pseudo terminal")
+	options.add_argument("--baud", type=int, default=115200, help="baud rate to emulate")
+	options.add_argument("--latency", type=float, default=0.5, help="processing time of the board in ms")
+	options.add_argument("--corrupt", type=float, default=0.0, help="probability of a bad checksum")
+	options.add_argument("--drop", type=float, default=0.0, help="probability of dropping a byte of a frame")
+	options.add_argument("--split", type=float, default=0.0, help="probability of splitting a frame in two writes")
+	options.add_argument("--seed", type=int, default=None, help="seed of the random faults and noise")
+	options.add_argument("--calibration", type=float, default=0.0, help="seconds the gyro calibrates after the start")
+	options.add_argument("--link", default=None, help="also make this symlink to the port")
+	args = options.parse_args()
+
+	sim = Simulator(args.baud, args.latency/1000.0, args.corrupt, args.drop, args.split, args.seed, args.calibration)
+	if args.link:
+		if os.path.islink(args.link):
+			os.remove(args.link)
+		os.symlink(sim.port, args.link)
+	print "Simulated MultiWii on "+sim.port+(" ("+args.link+")" if args.link else "")
+	sys.stdout.flush()
+	sim.start()
+	try:
+		while sim.is_alive():
+			sim.join(1)
+	except KeyboardInterrupt:
+		pass
+	print str(sim.requests)+" requests answered"
+	if args.link and os.path.islink(args.link):
+		os.remove(args.link)
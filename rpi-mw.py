@@ -20,9 +20,26 @@ import time			# for wait commands
 import datetime		# for current time
 import struct		# for decoding data strings
 import timeit		# for current time
-import asyncore 	# for asynchornous udp comm
-import SocketServer # for socketserver udp comm
 import threading 	# for using threads
+import collections	# for typed telemetry records
+import select		# for waiting on the serial port
+import ctypes		# for the monotonic clock
+import ctypes.util
+import heapq		# for the event loop timers
+import errno		# for non blocking sockets
+import re			# for parsing struct formats
+import json			# for the binary log header
+import os			# for the log files
+import Queue		# for the log writer queue
+import signal		# for showing the timings on demand
+import atexit		# for showing the timings at exit
+import multiprocessing	# for one process per board
+import fcntl		# for playing sessions
+import termios
+try:
+	import numpy	# for the telemetry history
+except ImportError:
+	numpy = None
 
 
 ##########################################################################
@@ -42,10 +59,45 @@ class drone(object):
 	RAW 	= 	0 	# Ask and save the raw imu data of the multicopter
 	CMD 	= 	0 	# Send commands to the MW to control it
 	UDP 	=	0 	# Save or use UDP data (to be adjusted)
-	ASY 	=	0 	# Use async communicacion
-	SCK 	=	0 	# Use regular socket communication
-	SCKSRV 	=	0 	# Use socketserver communication
 	PRINT 	= 	0 	# Print data to terminal, useful for debugging
+	BIN 	= 	0 	# Save the file as fixed size binary records (python rpi-mw.py tocsv <file> converts it)
+	HIST 	= 	0 	# Keep the last seconds of telemetry in memory, needs numpy
+	PROF 	= 	0 	# Time every stage of the loop (shown with kill -USR1 <pid> and at exit)
+	PIPE 	= 	1 	# Ask all the enabled messages at once instead of one after the other
+	SCHED 	= 	0 	# Ask each enabled message at its own rate from RATES
+	PUB 	= 	0 	# Publish the telemetry to other programs over TCP/UDP (see Publisher)
+	REC 	= 	0 	# Record every serial byte and UDP datagram to data/<timestamp>.cap (python rpi-mw.py play <file> plays it)
+	# Rate in Hz of every message, by priority (the last ones are slowed down first if the link is too slow)
+	RATES 	= 	[('MSP_ATTITUDE', 100), ('MSP_RAW_IMU', 50), ('MSP_RC', 50), ('MSP_MOTOR', 20), ('MSP_ALTITUDE', 10)]
+
+# The following lines define how the file is written
+logQueue = 4096				# Writes that can wait to be saved
+logPolicy = 'drop-oldest'	# When the queue is full: 'drop-oldest', 'drop-newest' or 'block'
+logFsync = 1.0				# Seconds between syncs to the SD card
+logRotateBytes = 0			# Start a new file after this many bytes (0 = never)
+logRotateSeconds = 0		# Start a new file after this many seconds (0 = never)
+recordBuffer = 1 << 20		# Bytes of each of the two buffers of the session recorder
+historySeconds = 30			# Seconds of telemetry kept in memory
+historyRate = 100			# Expected samples per second of the history
+mocapMerge = 'interpolate'	# How the UDP mocap is aligned to the MSP samples: 'interpolate', 'hold' or None (latest packet as it is)
+mocapMaxAge = 0.1			# Seconds a mocap sample is valid (and the longest a sample waits for the next packet)
+mocapSamples = 64			# Mocap packets and waiting sweeps kept for the merge
+
+# Boards acquired at once with "python rpi-mw.py boards", each in its own process
+# (board id, serial port, baud rate, rates of the messages like drone.RATES or None for drone.RATES)
+boards = [
+#	('quad1', '/dev/ttyUSB0', 115200, None),
+#	('rig', '/dev/ttyUSB1', 115200, [('MSP_ATTITUDE', 100), ('MSP_RAW_IMU', 100)]),
+]
+
+# The following lines define the RC commands sent to the MW (drone.CMD and drone.UDP)
+rcRate = 50					# Times per second MSP_SET_RAW_RC is sent
+rcTimeout = 0.2				# Seconds without a new UDP command before sending the failsafe values
+rcMin = 1000				# Lowest PWM of every channel
+rcMax = 2000				# Highest PWM of every channel
+txShares = [0.2, 0.6, 0.2]	# Share of the serial link reserved for control, telemetry and bulk (parameters) writes
+txSlack = 0.002				# Seconds of bytes that can wait in the serial driver ahead of the wire
+rcFailsafe = [1500, 1500, 1500, 1000, 1000, 1000, 1000, 1000]	# roll, pitch, yaw, throttle, aux1-4
 
 
 
@@ -69,14 +121,21 @@ ser.rtscts=False
 ser.dsrdtr=False
 ser.writeTimeout=2
 timeMSP=0.02
+timeSweep=0.05	# Maximum time to wait for all the answers of a pipelined request
 #Raspberry pie IP address
 udp_ip = "172.30.150.170"
 #Mac IP address
 #udp_ip = "130.209.27.59"
 #udp_ip = "localhost"
 udp_port = 51001
-sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-wakeUp = 8
+publishPort = 51010			# TCP and UDP port of the telemetry subscribers
+publishGroups = []			# Fixed UDP destinations: (ip, port, subscription line), like ('239.0.0.1', 51011, '* 0')
+publishBuffer = 65536		# Bytes a TCP subscriber can fall behind before it is dropped
+publishExpiry = 30			# Seconds a UDP subscription lasts without being renewed
+udpFields = None	# Names of the doubles of every UDP packet, a field named seq counts the lost packets (None = plain tuples)
+wakeUp = 8		# Longest wait for the MultiWii to answer and calibrate after opening the port
+readyStatus = 3	# MSP_STATUS answers in a row with no new I2C errors before starting
+metadataCache = "data/metadata.json"	# Box names, PID names, box ids and motor pins of every firmware seen
 
 
 ###############################
@@ -84,756 +143,3247 @@ wakeUp = 8
 ###############################
 latitude = 0.0
 longitude = 0.0
-altitude = -0
-heading = -0
 timestamp = -0
 gpsString = -0
 numSats = -0
 accuracy = -1
-beginFlag = 0
-roll = 0
-pitch = 0
-yaw = 0
-throttle = 0
-angx = 0.0
-angy = 0.0
-m1 = 0
-m2 = 0
-m3 = 0
-m4 = 0
 message = ""
-ax = 0
-ay = 0
-az = 0
-gx = 0
-gy = 0
-gz = 0
-magx = 0
-magy = 0
-magz = 0
 elapsed = 0
 flytime = 0
-udp_mess = ""
-udp_mess2 = ""
-numOfValues = 0
 precision = 3
 rcData = [1500, 1500, 1500, 1000] #order -> roll, pitch, yaw, throttle
+params = None	# ParameterStore of the running main(), on the live link
+history = None	# TelemetryHistory of the running main() (drone.HIST), saved to data/<timestamp>.npy at exit
 
 
 ##########################################################################
 ################################## UDP ###################################
 ##########################################################################
-# Class for the async UDP server
+# Class for the UDP endpoint, read by the event loop
 ##########################################################################
-class AsyncoreServerUDP(asyncore.dispatcher):
-	def __init__(self):
-		asyncore.dispatcher.__init__(self)
-		self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.bind((udp_ip, udp_port))
-	
-	# Even though UDP is connectionless this is called when it binds to a port
-	def handle_connect(self):
-		print "Server Started..."
-	
-	# This is called everytime there is something to read
-	def handle_read(self):
-		global udp_mess 
-		global udp_mess2
-		udp_mess=""
-		data, addr = self.recvfrom(1024)
-		numOfValues = len(data) / 8
-		mess=struct.unpack('>' + 'd' * numOfValues, data)
-		for x in range(0, numOfValues):
-			udp_mess = udp_mess+" "+str(mess[x])
-		udp_mess2=udp_mess
-
-   # This is called all the time and causes errors if you leave it out.
-	def handle_write(self):
-		pass
 
+#############################################################
+# UDPEndpoint(ip, port, fields)
+#	receives: address to listen on and the names of the big
+#		endian doubles of every packet (None for plain tuples)
+#	function: every time the socket is readable, drains all the
+#		queued datagrams with recv_into on a preallocated buffer
+#		and decodes only the latest one, with a struct built once
+#		per packet length. values is a typed record (a tuple
+#		without fields) and stamp is its arrival (monotonicNs).
+#		onPacket, if set, is called with both. Keeps the packet
+#		rate, the packets lost (from a field named seq) or
+#		superseded, and the inter-arrival jitter.
+#############################################################
+class UDPEndpoint(object):
+	def __init__(self, ip, port, fields=udpFields):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setblocking(0)
+		self.sock.bind((ip, port))
+		self.buf = bytearray(2048)
+		self.layouts = {}	# struct per packet length
+		self.record = None
+		self.fields = None	# names of the doubles, when known
+		self.seq = None		# index of the sequence number
+		if fields:
+			self.fields = list(fields)
+			self.record = collections.namedtuple('Mocap', fields)
+			if 'seq' in fields:
+				self.seq = list(fields).index('seq')
+		self.values = None	# latest packet
+		self.stamp = 0		# monotonicNs() when the latest packet arrived
+		self.onPacket = None
+		self.onDatagram = None	# called with every datagram as it arrived
+		self.packets = 0	# datagrams received
+		self.superseded = 0	# datagrams drained and replaced by a newer one
+		self.malformed = 0	# datagrams that do not match the fields
+		self.lost = 0		# gaps in seq
+		self.first = 0
+		self.interval = 0	# last inter-arrival time
+		self.jitter = 0.0	# running mean of the change of inter-arrival time (ns)
+		self.intervals = Histogram()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	# Struct for packets of n bytes, None if they do not match the fields
+	def layout(self, n):
+		s = self.layouts.get(n)
+		if s is None:
+			count = n / 8
+			if self.record is not None and count != len(self.record._fields):
+				return None
+			s = self.layouts[n] = struct.Struct('>%dd' % count)
+		return s
+
+	# Called by the event loop every time there is something to read
+	def onReadable(self):
+		n = -1
+		received = 0
+		while True:
+			try:
+				n = self.sock.recv_into(self.buf)
+			except socket.error, error:
+				if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise
+			received += 1
+			if self.onDatagram is not None:
+				self.onDatagram(buffer(self.buf, 0, n))
+		if not received:
+			return
+		stamp = monotonicNs()
+		self.packets += received
+		self.superseded += received-1
+		s = self.layout(n)
+		if s is None:
+			self.malformed += 1
+			return
+		values = s.unpack_from(self.buf)
+		if self.record is not None:
+			values = self.record._make(values)
+			if self.seq is not None and self.values is not None:
+				self.lost += max(0, int(values[self.seq]-self.values[self.seq])-received)
+		if self.stamp:
+			interval = stamp-self.stamp
+			self.intervals.add(interval)
+			if self.interval:
+				self.jitter += (abs(interval-self.interval)-self.jitter)/16.0
+			self.interval = interval
+		else:
+			self.first = stamp
+		self.values = values
+		self.stamp = stamp
+		if self.onPacket is not None:
+			self.onPacket(stamp, values)
 
-##########################################################################
-################################## UDP ###################################
-##########################################################################
-# Class for the socketserver 
-##########################################################################
-class SocketServerHandler(SocketServer.BaseRequestHandler):
-
-	def handle(self):
-		global udp_mess 
-		global udp_mess2
-		global rcData
-		udp_mess=""
-		numOfValues=0
-		timestamp = time.time()
-		data = self.request[0].strip()
-		socket = self.request[1]
-		try:
-			numOfValues = len(data) / 8
-			mess=struct.unpack('>' + 'd' * numOfValues, data)
-			for x in range(0, numOfValues):
-				udp_mess = udp_mess+" "+str(mess[x])
-			for x in range(0,3):
-				if mess[x] is not None:
-					rcData[x]=mess[x]
-			udp_mess2=udp_mess
-		except Exception,error:
-			#print "SocketServer: "+str(error)
-			pass
+	def report(self):
+		elapsed = (self.stamp-self.first)/1e9
+		rate = (self.packets-1)/elapsed if elapsed > 0 else 0.0
+		return "UDP packets: %d (%.1f Hz), lost %d, superseded %d, malformed %d, jitter %.2f ms, max interval %.2f ms" % (self.packets, rate, self.lost, self.superseded, self.malformed, self.jitter/1e6, self.intervals.max/1e6)
 
 
 #####################################################################
 ###################### MultiWii Serial Protocol######################
 #####################################################################
-#  The following define the hex values required
-#  to make various MSP requests
-################################################
+#  The following table describes every MSP message. Everything
+#  else (codes, request frames and decoders) is generated from it,
+#  so adding a message is a single entry.
+#	entry: [code, request length, response length, request format,
+#		response format, scale factors, field names, offsets]
+#	- field names, scale factors and offsets describe the response,
+#	  or the request for commands that only send data to the MW
+#	- scale factors and offsets are optional (None means raw values)
+#	- a format ending in '*' repeats its group for the whole payload
+#	  and every field is a tuple with one value per group (the
+#	  length is then the usual one, for the bandwidth planner)
+#	- the format 'names' is a list of names separated by ';'
+#####################################################################
 
 BASIC="\x24\x4d\x3c\x00"		#MSG Send Header (to MultiWii)
-MSP_IDT=BASIC+"\x64\x64"		#MSG ID: 100
-MSP_STATUS=BASIC+"\x65\x65"		#MSG ID: 101
-MSP_RAW_IMU=BASIC+"\x66\x66"	#MSG ID: 102
-MSP_SERVO=BASIC+"\x67\x67"		#MSG ID: 103
-MSP_MOTOR=BASIC+"\x68\x68"		#MSG ID: 104
-MSP_RC=BASIC+"\x69\x69"			#MSG ID: 105
-MSP_RAW_GPS=BASIC+"\x6A\x6A"	#MSG ID: 106
-MSP_ATTITUDE=BASIC+"\x6C\x6C"	#MSG ID: 108
-MSP_ALTITUDE=BASIC+"\x6D\x6D"	#MSG ID: 109
-MSP_BAT = BASIC+"\x6E\x6E"		#MSG ID: 110
-MSP_COMP_GPS=BASIC+"\x71\x71"	#MSG ID: 111
-MSP_SET_RC=BASIC+"\xC8\xC8"  	#MSG ID: 200
-
-CMD2CODE = {
-'MSP_IDENT':100,
-'MSP_STATUS':101,
-'MSP_RAW_IMU':102,
-'MSP_SERVO':103,
-'MSP_MOTOR':104,
-'MSP_RC':105,
-'MSP_RAW_GPS':106,
-'MSP_COMP_GPS':107,
-'MSP_ATTITUDE':108,
-'MSP_ALTITUDE':109,
-'MSP_ANALOG':110,
-'MSP_RC_TUNING':111,
-'MSP_PID':112,
-'MSP_BOX':113,
-'MSP_MISC':114,
-'MSP_MOTOR_PINS':115,
-'MSP_BOXNAMES':116,
-'MSP_PIDNAMES':117,
-'MSP_WP':118,
-'MSP_BOXIDS':119,
-
-'MSP_SET_RAW_RC':200,
-'MSP_SET_RAW_GPS':201,
-'MSP_SET_PID':202,
-'MSP_SET_BOX':203,
-'MSP_SET_RC_TUNING':204,
-'MSP_ACC_CALIBRATION':205,
-'MSP_MAG_CALIBRATION':206,
-'MSP_SET_MISC':207,
-'MSP_RESET_CONF':208,
-'MSP_SET_WP':209,
-'MSP_SWITCH_RC_SERIAL':210,
-'MSP_IS_SERIAL':211,
-'MSP_DEBUG':254,
-}
 
-################################################
-# ALTITUDE(msp)
-#	receives: msp altitude message
-#	outputs:  prints data in nice format
-#	returns:  Angle in X, Y and heading
-################################################
-def ATTITUDE(msp):
-	global angx
-	global angy
-	global heading
-	if str(msp) == "":
-		#print(msp_hex)
-		#print("Header: " + msp_hex[:6])
-		#payload = int(msp_hex[6:8])
-		#print("Payload: " + msp_hex[6:8])
-		#print("Code: " + msp_hex[8:10])
-		#print("RC data unavailable")
-		return
-	else:
-		msp_hex = msp.encode("hex")
-		if msp_hex[10:14] == "":
-			#print("angx unavailable")
-			return
-		else:
-			angx = littleEndian(msp_hex[10:14])/10.0
+msp_dict={
+	'MSP_IDENT': [100, 0, 7, '', '<BBBI', None, ['version', 'multitype', 'msp_version', 'capability']],
+	'MSP_STATUS': [101, 0, 11, '', '<HHHIB', None, ['cycleTime', 'i2c_errors', 'sensor', 'flag', 'currentSet']],
+	'MSP_RAW_IMU': [102, 0, 18, '', '<'+'h'*9, None, ['ax', 'ay', 'az', 'gx', 'gy', 'gz', 'magx', 'magy', 'magz']],
+	'MSP_SERVO': [103, 0, 16, '', '<'+'H'*8, None, ['s1', 's2', 's3', 's4', 's5', 's6', 's7', 's8']],
+	'MSP_MOTOR': [104, 0, 16, '', '<'+'H'*8, None, ['m1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7', 'm8']],
+	'MSP_RC': [105, 0, 16, '', '<'+'H'*8, None, ['roll', 'pitch', 'yaw', 'throttle', 'aux1', 'aux2', 'aux3', 'aux4']],
+	'MSP_RAW_GPS': [106, 0, 16, '', '<BBiiHHH', [1., 1., 1e-7, 1e-7, 1., 0.01, 0.1], ['fix', 'numSat', 'lat', 'lon', 'altitude', 'speed', 'course']],
+	'MSP_COMP_GPS': [107, 0, 5, '', '<HhB', None, ['distanceToHome', 'directionToHome', 'update']],
+	'MSP_ATTITUDE': [108, 0, 6, '', '<'+'h'*3, [0.1, 0.1, 1.], ['angx', 'angy', 'heading'], [0., 0., 5.]],
+	'MSP_ALTITUDE': [109, 0, 6, '', '<ih', [0.01, 1.], ['altitude', 'vario']],
+	'MSP_ANALOG': [110, 0, 7, '', '<BHHH', [0.1, 1., 1., 1.], ['vbat', 'powerMeterSum', 'rssi', 'amperage']],
+	'MSP_RC_TUNING': [111, 0, 7, '', '<'+'B'*7, [0.01]*7, ['rcRate', 'rcExpo', 'rollPitchRate', 'yawRate', 'dynThrPID', 'thrMid', 'thrExpo']],
+	'MSP_PID': [112, 0, 30, '', '<BBB*', None, ['p', 'i', 'd']],
+	'MSP_BOX': [113, 0, 24, '', '<H*', None, ['items']],
+	'MSP_MISC': [114, 0, 22, '', '<HHHHHHIhBBBB', [1., 1., 1., 1., 1., 1., 1., 0.1, 1., 0.1, 0.1, 0.1], ['powerTrigger', 'minThrottle', 'maxThrottle', 'minCommand', 'failsafeThrottle', 'armCount', 'lifetime', 'magDeclination', 'vbatScale', 'vbatWarn1', 'vbatWarn2', 'vbatCritical']],
+	'MSP_MOTOR_PINS': [115, 0, 8, '', '<'+'B'*8, None, ['pin1', 'pin2', 'pin3', 'pin4', 'pin5', 'pin6', 'pin7', 'pin8']],
+	'MSP_BOXNAMES': [116, 0, 64, '', 'names', None, ['names']],
+	'MSP_PIDNAMES': [117, 0, 64, '', 'names', None, ['names']],
+	'MSP_WP': [118, 1, 18, '<B', '<BiiIhHB', [1., 1e-7, 1e-7, 0.01, 1., 1., 1.], ['number', 'lat', 'lon', 'altitude', 'heading', 'stayTime', 'flag']],
+	'MSP_BOXIDS': [119, 0, 12, '', '<B*', None, ['ids']],
+
+	'MSP_SET_RAW_RC': [200, 16, 0, '<'+'H'*8, '', None, ['roll', 'pitch', 'yaw', 'throttle', 'aux1', 'aux2', 'aux3', 'aux4']],
+	'MSP_SET_RAW_GPS': [201, 14, 0, '<BBiiHH', '', [1., 1., 1e-7, 1e-7, 1., 0.01], ['fix', 'numSat', 'lat', 'lon', 'altitude', 'speed']],
+	'MSP_SET_PID': [202, 30, 0, '<BBB*', '', None, ['p', 'i', 'd']],
+	'MSP_SET_BOX': [203, 24, 0, '<H*', '', None, ['items']],
+	'MSP_SET_RC_TUNING': [204, 7, 0, '<'+'B'*7, '', [0.01]*7, ['rcRate', 'rcExpo', 'rollPitchRate', 'yawRate', 'dynThrPID', 'thrMid', 'thrExpo']],
+	'MSP_ACC_CALIBRATION': [205, 0, 0, '', '', None, []],
+	'MSP_MAG_CALIBRATION': [206, 0, 0, '', '', None, []],
+	'MSP_SET_MISC': [207, 22, 0, '<HHHHHHIhBBBB', '', [1., 1., 1., 1., 1., 1., 1., 0.1, 1., 0.1, 0.1, 0.1], ['powerTrigger', 'minThrottle', 'maxThrottle', 'minCommand', 'failsafeThrottle', 'armCount', 'lifetime', 'magDeclination', 'vbatScale', 'vbatWarn1', 'vbatWarn2', 'vbatCritical']],
+	'MSP_RESET_CONF': [208, 0, 0, '', '', None, []],
+	'MSP_SET_WP': [209, 18, 0, '<BiiIhHB', '', [1., 1e-7, 1e-7, 0.01, 1., 1., 1.], ['number', 'lat', 'lon', 'altitude', 'heading', 'stayTime', 'flag']],
+	'MSP_SWITCH_RC_SERIAL': [210, 0, 0, '', '', None, []],
+	'MSP_IS_SERIAL': [211, 0, 0, '', '', None, []],
+	'MSP_EEPROM_WRITE': [250, 0, 0, '', '', None, []],
+	'MSP_DEBUG': [254, 0, 8, '', '<'+'h'*4, None, ['debug1', 'debug2', 'debug3', 'debug4']]}
+
+CMD2CODE = dict([(name, entry[0]) for name, entry in msp_dict.items()])
+CODE2CMD = dict([(code, name) for name, code in CMD2CODE.items()])
 
-		if msp_hex[14:18] == "":
-			#print("angy unavailable")
-			return
-		else:
-			angy = littleEndian(msp_hex[14:18])/10.0
 
-		if msp_hex[18:22] == "":
-			#print("head unavailable")
-			return
+#############################################################
+# requestFrame(code)
+#	receives: MSP code
+#	returns:  the request (with no payload) to send to the MW
+#############################################################
+def requestFrame(code):
+	return BASIC+chr(code)+chr(code)
+
+# Requests for every MSP name that is sent with no payload, built once
+MSP_REQUESTS = dict([(name, requestFrame(entry[0])) for name, entry in msp_dict.items() if not entry[1]])
+
+# drone flags and the MSP message each of them asks for
+DRONE_MESSAGES = [('ATT', 'MSP_ATTITUDE'), ('ALT', 'MSP_ALTITUDE'), ('RC', 'MSP_RC'), ('MOT', 'MSP_MOTOR'), ('RAW', 'MSP_RAW_IMU')]
+
+def enabledMessages():
+	return [name for flag, name in DRONE_MESSAGES if getattr(drone, flag)]
+
+# drone.RATES of the enabled messages, every one of them must have a rate
+def enabledRates():
+	messages = enabledMessages()
+	missing = [name for name in messages if name not in dict(drone.RATES)]
+	if missing:
+		raise ValueError("No rate in drone.RATES for "+", ".join(missing))
+	return [(name, hz) for name, hz in drone.RATES if name in messages]
+
+
+#############################################################
+# MSPCodec(name, entry)
+#	receives: the MSP name and its msp_dict entry
+#	function: precompiles the layout of the message into a
+#		struct and a record type, then decodes payloads with
+#		unpack_from directly on the received bytes and encodes
+#		requests with pack. Repeated groups get one struct per
+#		number of groups, built the first time it is seen.
+#############################################################
+class MSPCodec(object):
+	def __init__(self, name, entry):
+		self.name = name
+		self.code = entry[0]
+		self.requestFormat = entry[3]
+		self.responseFormat = entry[4]
+		layout = entry[4] or entry[3]	# the side the fields describe
+		self.fields = entry[6]
+		self.scales = entry[5] or [1.]*len(self.fields)
+		if len(entry) > 7:
+			self.offsets = entry[7]
+		else:
+			self.offsets = [0.]*len(self.fields)
+		self.scaled = entry[5] is not None
+		self.request = MSP_REQUESTS.get(name)
+		# request payload of a message that also has a response (MSP_WP)
+		self.requestStruct = None
+		if entry[3] and entry[4]:
+			self.requestStruct = struct.Struct(entry[3])
+		if layout == 'names':
+			self.kind = 'names'
+			self.struct = struct.Struct('')
+			self.zero = ('',)
+		elif layout.endswith('*'):
+			self.kind = 'repeat'
+			self.group = layout[1:-1]
+			self.struct = struct.Struct(layout[:-1])
+			self.repeats = {}
+			self.zero = ()
 		else:
-			heading = littleEndian(msp_hex[18:22])+5
+			self.kind = 'fixed'
+			self.struct = struct.Struct(layout)
+			self.zero = (0,)*len(self.fields)
+		self.size = self.struct.size
+		typename = ''.join([w.capitalize() for w in name[4:].split('_')])
+		self.record = collections.namedtuple(typename, self.fields)
+		self.empty = self.make(self.zero)
+
+	# Struct of n repeated groups
+	def repeated(self, n):
+		s = self.repeats.get(n)
+		if s is None:
+			s = self.repeats[n] = struct.Struct('<'+self.group*n)
+		return s
+
+	# Raw integer values as they travel on the wire, None if the payload is short
+	def unpack(self, payload, offset=0):
+		if self.kind == 'fixed':
+			if len(payload) - offset < self.size:
+				return None
+			return self.struct.unpack_from(payload, offset)
+		if self.kind == 'repeat':
+			return self.repeated((len(payload)-offset) / self.size).unpack_from(payload, offset)
+		return (str(bytearray(payload[offset:])),)
+
+	# Applies scale factors and offsets and builds the typed record
+	def make(self, raw):
+		if self.kind == 'fixed':
+			if self.scaled:
+				raw = [v*s+o for v, s, o in zip(raw, self.scales, self.offsets)]
+			return self.record._make(raw)
+		if self.kind == 'repeat':
+			n = len(self.fields)
+			columns = [raw[i::n] for i in range(n)]
+			if self.scaled:
+				columns = [tuple([v*s+o for v in c]) for c, s, o in zip(columns, self.scales, self.offsets)]
+			return self.record._make(columns)
+		return self.record(tuple([x for x in raw[0].split(';') if x]))
+
+	def decode(self, payload, offset=0):
+		raw = self.unpack(payload, offset)
+		if raw is None:
+			return None
+		return self.make(raw)
+
+	# Raw integer values of a record (or of a list of values in the same order)
+	def raw(self, values):
+		if self.kind == 'names':
+			return (';'.join(values[0])+';',)
+		if self.kind == 'repeat':
+			values = [[int(round((v-o)/s)) for v in c] for c, s, o in zip(values, self.scales, self.offsets)]
+			return [v for group in zip(*values) for v in group]
+		return [int(round((v-o)/s)) for v, s, o in zip(values, self.scales, self.offsets)]
+
+	# Payload bytes for raw values
+	def pack(self, raw):
+		if self.kind == 'names':
+			return raw[0]
+		if self.kind == 'repeat':
+			return self.repeated(len(raw) / len(self.fields)).pack(*raw)
+		return self.struct.pack(*raw)
+
+	# Complete request frame to send to the MW with these values
+	def encode(self, values=()):
+		if self.request is not None:
+			return self.request
+		if self.requestStruct is not None:
+			payload = self.requestStruct.pack(*values)
+		else:
+			payload = self.pack(self.raw(values))
+		frame = bytearray('$M<'+chr(len(payload))+chr(self.code)+payload+'\x00')
+		frame[-1] = xorChecksum(frame, 3, len(frame)-1)
+		return str(frame)
+
+
+# Codecs indexed by MSP code and by MSP name
+MSP_CODECS = {}
+MSP_CODECS_BY_NAME = {}
+for name, entry in msp_dict.items():
+	MSP_CODECS[entry[0]] = MSP_CODECS_BY_NAME[name] = MSPCodec(name, entry)
+
+
+#############################################################
+# decode(code, payload, offset)
+#	receives: MSP code, the payload bytes and where the payload starts
+#	returns:  the typed record, or None if unknown or too short
+#############################################################
+def decode(code, payload, offset=0):
+	codec = MSP_CODECS.get(code)
+	if codec is None:
+		return None
+	return codec.decode(payload, offset)
+
+
+#############################################################
+# decodeFrame(msp, name)
+#	receives: a complete MSP response ($M> header, size, code,
+#		payload, checksum) and the MSP name expected
+#	returns:  the typed record, or None if unavailable
+#############################################################
+def decodeFrame(msp, name):
+	if len(msp) < 5:
+		return None
+	return MSP_CODECS_BY_NAME[name].decode(msp, 5)
+
+
+################################################
+# ATTITUDE(msp)
+#	receives: msp attitude message
+#	returns:  Attitude record (angx, angy, heading)
+################################################
+def ATTITUDE(msp):
+	return decodeFrame(msp, 'MSP_ATTITUDE')
 
 
 ################################################
 # ALTITUDE(msp)
 #	receives: msp altitude message
-#	outputs:  prints data in nice format
-#	returns:  Altitude in CSV
+#	returns:  Altitude record (altitude in meters, vario)
 ################################################
 def ALTITUDE(msp):
-	global beginFlag
-	global altitude
-	if str(msp) == "":
-		#print(msp_hex)
-		#print("Header: " + msp_hex[:6])
-		#payload = int(msp_hex[6:8])
-		#print("Payload: " + msp_hex[6:8])
-		#print("Code: " + msp_hex[8:10])
-		#print("Altitude unavailable")
-		beginFlag = 1	# set flag to 1
-		return
-	else:
-		msp_hex = msp.encode("hex")
-		if msp_hex[10:18] == "":
-			#print("Altitude unavailable2")
-			beginFlag = 1
-			return
-		else:
-			altitude = float(littleEndian(msp_hex[10:18]))/100
-			#print("Altitude: " + str(altitude) + " meters")
-			return
+	return decodeFrame(msp, 'MSP_ALTITUDE')
 
 
 ################################################
 # RC(msp)
-#\t   receives: msp RC message
-#\t   outputs:  prints data in nice format
-#\t   returns:  Roll/Pitch/Yaw/Throttle
+#	receives: msp RC message
+#	returns:  Rc record (roll, pitch, yaw, throttle, aux1-4)
 ################################################
 def RC(msp):
-	global roll
-	global pitch
-	global yaw
-	global throttle
-	if str(msp) == "":
-		#print(msp_hex)
-		#print("Header: " + msp_hex[:6])
-		#payload = int(msp_hex[6:8])
-		#print("Payload: " + msp_hex[6:8])
-		#print("Code: " + msp_hex[8:10])
-		#print("RC data unavailable")
-		return
-	else:
-		msp_hex = msp.encode("hex")
-
-		if msp_hex[10:14] == "":
-			#print("roll unavailable")
-			return
-		else:
-			roll = float(littleEndian(msp_hex[10:14]))
-
-		if msp_hex[14:18] == "":
-			#print("pitch unavailable")
-			return
-		else:
-			pitch = float(littleEndian(msp_hex[14:18]))
-
-		if msp_hex[18:22] == "":
-			#print("yaw unavailable")
-			return
-		else:
-			yaw = float(littleEndian(msp_hex[18:22]))
-
-		if msp_hex[22:26] == "":
-			#print("throttle unavailable")
-			return
-		else:
-			throttle = float(littleEndian(msp_hex[22:26]))
-			return
-		#print(str(roll) + " " + str(pitch) + " " + str(yaw) + " " + str(throttle))
+	return decodeFrame(msp, 'MSP_RC')
 
 
 ################################################
 # MOTORS(msp)
-#\t   receives: msp MOTORS message
-#\t   outputs:  prints data in nice format
-#\t   returns:  motor 1/motor 2/motor 3/motor 4
+#	receives: msp MOTORS message
+#	returns:  Motor record (m1-m8)
 ################################################
 def MOTORS(msp):
-	global m1
-	global m2
-	global m3
-	global m4
-	if str(msp) == "":
-		#print(msp_hex)
-		#print("Header: " + msp_hex[:6])
-		#payload = int(msp_hex[6:8])
-		#print("Payload: " + msp_hex[6:8])
-		#print("Code: " + msp_hex[8:10])
-		#print("RC data unavailable")
-		return
-	else:
-		msp_hex = msp.encode("hex")
-
-		if msp_hex[10:14] == "":
-			#print("motor 1 unavailable")
-			return
-		else:
-			m1 = float(littleEndian(msp_hex[10:14]))
-
-		if msp_hex[14:18] == "":
-			#print("motor 2 unavailable")
-			return
-		else:
-			m2 = float(littleEndian(msp_hex[14:18]))
-
-		if msp_hex[18:22] == "":
-			#print("motor 3 unavailable")
-			return
-		else:
-			m3 = float(littleEndian(msp_hex[18:22]))
-
-		if msp_hex[22:26] == "":
-			#print("motor 4 unavailable")
-			return
-		else:
-			m4 = float(littleEndian(msp_hex[22:26]))
-			return
-		#print(str(roll) + " " + str(pitch) + " " + str(yaw) + " " + str(throttle))
+	return decodeFrame(msp, 'MSP_MOTOR')
 
 
 ################################################
 # RAW(msp)
-#\t   receives: msp raw message
-#\t   outputs:  prints data in nice format
-#\t   returns:  ax/ay/az/gx/gy/gz/magx/magy/magz
+#	receives: msp raw message
+#	returns:  RawImu record (ax/ay/az/gx/gy/gz/magx/magy/magz)
 ################################################
 def RAW(msp):
-	global ax
-	global ay
-	global az
-	global gx
-	global gy
-	global gz
-	global magx
-	global magy
-	global magz
-	if str(msp) == "":
-		#print(msp_hex)
-		#print("Header: " + msp_hex[:6])
-		#payload = int(msp_hex[6:8])
-		#print("Payload: " + msp_hex[6:8])
-		#print("Code: " + msp_hex[8:10])
-		#print("RC data unavailable")
-		return
-	else:
-		msp_hex = msp.encode("hex")
-		if msp_hex[10:14] == "":
-			#print("ax unavailable")
-			return
-		else:
-			ax = float(littleEndian(msp_hex[10:14]))
-		
-		if msp_hex[14:18] == "":
-			#print("ay unavailable")
-			return
-		else:
-			ay = float(littleEndian(msp_hex[14:18]))
+	return decodeFrame(msp, 'MSP_RAW_IMU')
 
-		if msp_hex[18:22] == "":
-			#print("az unavailable")
-			return
-		else:
-			az = float(littleEndian(msp_hex[18:22]))
 
-		if msp_hex[22:26] == "":
-			#print("gx unavailable")
-			return
-		else:
-			gx = float(littleEndian(msp_hex[22:26]))
-		
-		if msp_hex[26:30] == "":
-			#print("gy unavailable")
-			return
-		else:
-			gy = float(littleEndian(msp_hex[26:30]))
+#############################################################
+# xorChecksum(buf, start, end)
+#	receives: a buffer and the range of bytes to check
+#	function: XORs the range a 32 bit word at a time and folds
+#		the result into one byte, so the payload is not walked
+#		byte by byte in python
+#	returns:  the MSP checksum of that range
+#############################################################
+xor_structs = {}
 
-		if msp_hex[30:34] == "":
-			#print("gz unavailable")
-			return
-		else:
-			gz = float(littleEndian(msp_hex[30:34]))
+def xorChecksum(buf, start, end):
+	n = end - start
+	s = xor_structs.get(n)
+	if s is None:
+		s = xor_structs[n] = struct.Struct('<%dI%dB' % (n >> 2, n & 3))
+	checksum = 0
+	for word in s.unpack_from(buf, start):
+		checksum ^= word
+	checksum ^= checksum >> 16
+	checksum ^= checksum >> 8
+	return checksum & 0xFF
 
-		if msp_hex[34:38] == "":
-			#print("magx unavailable")
-			return
-		else:
-			magx = float(littleEndian(msp_hex[34:38]))
-		
-		if msp_hex[38:42] == "":
-			#print("magy unavailable")
-			return
-		else:
-			magy = float(littleEndian(msp_hex[38:42]))
 
-		if msp_hex[42:46] == "":
-			#print("magz unavailable")
-			return
-		else:
-			magz = float(littleEndian(msp_hex[42:46]))
-			return
-		#print(str(roll) + " " + str(pitch) + " " + str(yaw) + " " + str(throttle))  
+#############################################################
+# CommandFrame(name)
+#	receives: MSP name of a command that sends data to the MW
+#	function: keeps the whole frame of the command in a
+#		preallocated bytearray with the header already written.
+#		send() packs the raw values in place with pack_into,
+#		writes the checksum and sends the frame in one write,
+#		so nothing is allocated per command. Every write is
+#		timed into timing (a Histogram, ns).
+#############################################################
+class CommandFrame(object):
+	def __init__(self, name):
+		codec = MSP_CODECS_BY_NAME[name]
+		if codec.kind != 'fixed':
+			raise ValueError(name+" has no fixed layout")
+		self.name = name
+		self.struct = codec.requestStruct or codec.struct
+		size = self.struct.size
+		self.frame = bytearray(6+size)
+		self.frame[0:5] = '$M<'+chr(size)+chr(codec.code)
+		self.end = 5+size	# where the checksum goes
+		self.timing = Histogram()
+		self.errors = 0
+
+	# Sends the raw values, returns the bytes written or None. done is
+	# given to the write of a ClassPort (called when it is on the wire).
+	def send(self, port, values, done=None):
+		frame = self.frame
+		self.struct.pack_into(frame, 5, *values)
+		frame[self.end] = xorChecksum(frame, 3, self.end)
+		start = monotonicNs()
+		try:
+			if done is None:
+				n = port.write(frame)
+			else:
+				n = port.write(frame, done)
+		except Exception, error:
+			self.errors += 1
+			print "send "+self.name+" error: "+str(error)
+			return None
+		self.timing.add(monotonicNs()-start)
+		return n
+
+
+command_frames = {}	# CommandFrame per MSP name, built the first time it is sent
+
+def commandFrame(name):
+	command = command_frames.get(name)
+	if command is None:
+		command = command_frames[name] = CommandFrame(name)
+	return command
+
+
+#############################################################
+# sendCommand(name, values)
+#	receives: MSP name of the command and its raw values
+#	function: sends the command to the MW through its CommandFrame,
+#		in its class of the transmit queue while main() runs
+#	returns:  bytes written, None on errors
+#############################################################
+def sendCommand(name, values):
+	if tx_ports is None:
+		return commandFrame(name).send(ser, values)
+	return commandFrame(name).send(tx_ports[TX_COMMANDS.get(name, TX_BULK)], values)
+
+
+#############################################################
+# commandReport()
+#	returns:  text table with the write time of every command sent
+#############################################################
+def commandReport():
+	lines = ["%-22s %9s %10s %10s %10s %7s" % ("command", "count", "p50 (us)", "p99 (us)", "max (us)", "errors")]
+	for name, command in sorted(command_frames.items()):
+		h = command.timing
+		lines.append("%-22s %9d %10.1f %10.1f %10.1f %7d" % (name, h.count, h.percentile(0.5)/1e3, h.percentile(0.99)/1e3, h.max/1e3, command.errors))
+	return "\n".join(lines)
 
 
 #############################################################
 # sendData(data_length, code, data)
 #	receives: the data length of the message, the code to send and the actual data to send
 #	outputs:  errors
-#	
+#	returns:  bytes written, None on errors
 #############################################################
+def sendData(data_length, code, data):
+	name = CODE2CMD[code]
+	if commandFrame(name).struct.size != data_length:
+		print 'send data error'
+		return None
+	return sendCommand(name, data)
 
 
-def sendData(data_length, code, data):
-	checksum = 0
-	total_data = ['$', 'M', '<', data_length, code] + data
-	for i in struct.pack('<2B%dh' % len(data), *total_data[3:len(total_data)]):
-		checksum = checksum ^ ord(i)
+#############################################################
+# MSPParser(direction, size)
+#	receives: '>' to parse answers from the MW, '<' to parse
+#		requests to the MW, and the size of the buffer
+#	function: streaming MSP frame parser. Bytes are fed in
+#		whatever chunks they arrive and every complete frame
+#		with a valid checksum is returned as (code, payload),
+#		where payload is a memoryview on the internal buffer.
+#		The payload is only valid until the next feed().
+#		Frames with a bad checksum are skipped and the parser
+#		resynchronises on the next header.
+#############################################################
+class MSPParser(object):
+	def __init__(self, direction='>', size=4096):
+		self.header = '$M'+direction
+		self.buf = bytearray(size)	# preallocated, never resized
+		self.view = memoryview(self.buf)
+		self.head = 0	# first byte not parsed yet
+		self.tail = 0	# end of the received bytes
+		self.frames = 0	# good frames returned
+		self.errors = 0	# frames dropped by checksum
+		self.overruns = 0	# bytes dropped because the buffer was full
+
+	# Appends received bytes, compacting the buffer when needed
+	def feed(self, data):
+		n = len(data)
+		if n == 0:
+			return
+		size = len(self.buf)
+		if n > size:
+			self.overruns += n - size
+			data = data[n-size:]
+			n = size
+		if self.tail + n > size:
+			pending = self.tail - self.head
+			if pending + n > size:
+				self.overruns += pending + n - size
+				self.head = self.tail - (size - n)
+				pending = size - n
+			self.buf[0:pending] = self.buf[self.head:self.tail]
+			self.head = 0
+			self.tail = pending
+		self.buf[self.tail:self.tail+n] = data
+		self.tail += n
+
+	# Returns the next complete frame as (code, payload) or None
+	def readFrame(self):
+		buf = self.buf
+		while True:
+			start = buf.find(self.header, self.head, self.tail)
+			if start < 0:
+				self.head = max(self.head, self.tail-2)	# the header may be split
+				return None
+			self.head = start
+			if start+5 > self.tail:
+				return None
+			end = start+6+buf[start+3]
+			if end > self.tail:
+				return None
+			if xorChecksum(buf, start+3, end-1) != buf[end-1]:
+				self.errors += 1
+				self.head = start+1	# resync on the next header
+				continue
+			self.head = end
+			self.frames += 1
+			return buf[start+4], self.view[start+5:end-1]
+
+	def __iter__(self):
+		frame = self.readFrame()
+		while frame is not None:
+			yield frame
+			frame = self.readFrame()
+
+
+parser = MSPParser()
 
-	total_data.append(checksum)
 
-	#print ser
-	try:
-		b = None
-		b = ser.write(struct.pack('<3c2B%dhB' % len(data), *total_data))
-		#ser.flushInput()	# cleans out the serial port
-		#ser.flushOutput()
-	except Exception, ex:
-		print 'send data error'
-	return b
+#############################################################
+# receiveData(timeout)
+#	receives: how long to wait for a frame
+#	function: feeds whatever the serial port has into the parser
+#		until a complete frame is available
+#	returns:  (error, code, record), error is 1 if nothing valid
+#		arrived on time, record is None for unknown codes
+#############################################################
+def receiveData(timeout=timeMSP):
+	deadline = timeit.default_timer() + timeout
+	while True:
+		frame = parser.readFrame()
+		if frame is not None:
+			code, payload = frame
+			return (0, code, decode(code, payload))
+		if timeit.default_timer() > deadline:
+			return (1, None, None)
+		data = ser.read(max(1, ser.inWaiting()))
+		if data:
+			parser.feed(data)
+		else:
+			time.sleep(0.001)
 
 
-msp_dict={
-	'MSP_RC': [0, 16, '', '='+'h'*8],
-	'MSP_ATTITUDE': [0, 8, '', '='+'h'*4],
-	'MSP_ALTITUDE': [0, 6, '', '=ih', [0.01, 1.]],
-	'MSP_STATUS': [0, 11, '', '='+'hhhIB'],
-	'MSP_CONTROL': [16, 14, '='+'h'*8, '='+'h'*7, [0.1, 0.1, -1., 1., 1., 1., 1.]]}
-
-
-S_END=0
-S_HEADER=1
-S_SIZE=2
-S_CMD=3
-S_DATA=4
-S_CHECKSUM=5
-S_ERROR=6
-
-def receiveData():
-	global roll
-	global pitch
-	global yaw
-	global throttle
-	data_to_read=1
-	state=S_HEADER
-	checksum=0
-	input_packet=''
-	while (state!=S_END) and (state!=S_ERROR):
-		#print "Data to read", data_to_read
-		c=ser.read(data_to_read)
-		input_packet+=c
-		#print "c: ", map(str,c), map(ord,c)
-		if state==S_HEADER:
-			if c=='$':
-				c=ser.read(2)
-				input_packet+=c
-				#print "c: ", map(str,c), map(ord,c)
-				if c=='M>':
-					#print "header received"
-					state=S_SIZE
-				else:
-					#print "Error in header1"
-					state=S_ERROR
-			else:
-				#print "Error: No header received"
-				state=S_ERROR
-		elif state==S_SIZE:
-			data_size=c
-			checksum^=ord(data_size)
-			state=S_CMD
-			#print "Data size: ", ord(data_size)
-		elif state==S_CMD:
-			cmd=c
-			checksum^=ord(cmd)
-			if ord(data_size)==0:
-				data_to_read=1
-				state=S_CHECKSUM
-			else:
-				data_to_read=ord(data_size)
-				state=S_DATA
-			#print "Command: ", ord(cmd)
-		elif state==S_DATA:
-			data_raw=c
-			#print "Data received", map(ord,data_raw)
-			checksum^=reduce(lambda x,y:x^y, map(ord,data_raw))
-			state=S_CHECKSUM
-			data_to_read=1
-		elif state==S_CHECKSUM:
-			#print "Calculated checksum: ", checksum, " Received checksum: ", ord(c)
-			if checksum!=ord(c):
-				#print "Error in checksum"
-				state=S_ERROR
-			else:
-				#print "Checksum is right"
-				state=S_END
-	if state==S_END:
-		error=0
-		if ord(cmd)==105:
-			#for i in xrange(len(data_raw)/2):
-			#    print ord(data_raw[2*i]), ord(data_raw[2*i+1])
-			#    print (ord(data_raw[2*i])<<0) | (ord(data_raw[2*i+1]) << 8)
-			data=[(ord(data_raw[2*i])) | (ord(data_raw[2*i+1])<<8) for i in xrange(len(data_raw)/2)]
-			#roll=data[0]
-			#pitch=data[1]
-			#yaw=data[2]
-			#throttle=data[3]
-			print "Data: ", data
-		elif ord(cmd)==MSP_RAW_IMU:
-			data=[(ord(data_raw[2*i])) | (ord(data_raw[2*i+1])<<8) for i in xrange(len(data_raw)/2)]
-			print "Data: ", data
-		elif ord(cmd)==MSP_SET_RAW_RC:
-			data=[]
+#############################################################
+# pollSweep(names, timeout)
+#	receives: list of MSP names to ask and how long to wait
+#	function: writes all the requests back to back in one write
+#		and matches the answers by code as they stream in,
+#		until all of them arrived or the timeout expires
+#	returns:  dictionary of MSP name -> record for the answers
+#		that arrived
+#############################################################
+sweep_requests = {}	# concatenated requests per list of names
+
+def pollSweep(names, timeout=timeSweep):
+	key = tuple(names)
+	request = sweep_requests.get(key)
+	if request is None:
+		request = sweep_requests[key] = ''.join([MSP_REQUESTS[name] for name in names])
+	pending = set([CMD2CODE[name] for name in names])
+	records = {}
+	ser.write(request)
+	deadline = timeit.default_timer() + timeout
+	while True:
+		for code, payload in parser:
+			if code in pending:
+				record = decode(code, payload)
+				if record is not None:
+					records[CODE2CMD[code]] = record
+					pending.discard(code)
+		if not pending or timeit.default_timer() > deadline:
+			return records
+		data = ser.read(max(1, ser.inWaiting()))
+		if data:
+			parser.feed(data)
 		else:
-			data=[]
-	else: #error
-		#print "input_packet: ", input_packet, map(ord, input_packet)
-		data=[]
-		error=1
-		ser.flushInput()
-	return((error,data))
-
-#############################################################
-# littleEndian(value)
-#	receives: a parsed, hex data piece
-#	outputs:  the decimal value of that data
-#	function: swaps byte by byte to convert little
-#			endian to big endian
-#	function: calls 2's compliment to convert to decimal
-#	returns:  The integer value
-#############################################################
-def littleEndian(value):
-	length = len(value)	# gets the length of the data piece
-	actual = ""
-	for x in range(0, length/2):	#go till you've reach the halway point
-		actual += value[length-2-(2*x):length-(2*x)]	#flips all of the bytes (the last shall be first)
-		x += 1
-	intVal = twosComp(actual)	# sends the data to be converted from 2's compliment to int
-	return intVal				# returns the integer value
-
-
-###################################################################
-# twosComp(hexValue)
-#	receives: the big endian hex value (correct format)
-#	outputs:  the decimal value of that data
-#	function: if the value is negative, swaps all bits
-#			up to but not including the rightmost 1.
-#			Else, just converts straight to decimal.
-#			(Flip all the bits left of the rightmost 1)
-#	returns:  the integer value
-###################################################################
-def twosComp(hexValue):
-	firstVal = int(hexValue[:1], 16)
-	if firstVal >= 8:	# if first bit is 1
-		bValue = bin(int(hexValue, 16))
-		bValue = bValue[2:]	# removes 0b header
-		newBinary = []
-		length = len(bValue)
-		index = bValue.rfind('1')	# find the rightmost 1
-		for x in range(0, index+1):	# swap bits up to rightmost 1
-			if x == index:		#if at rightmost one, just append remaining bits
-				newBinary.append(bValue[index:])
-			elif bValue[x:x+1] == '1':
-				newBinary.append('0')
-			elif bValue[x:x+1] == '0':
-				newBinary.append('1')
-			x += 1
-		newBinary = ''.join(newBinary) 	# converts char array to string
-		finalVal = -int(newBinary, 2)	# converts to decimal
-		return finalVal
-			
-	else:		# if not a negative number, simply convert to decimal
-		return int(hexValue, 16)
+			time.sleep(0.0005)
 
 
 #############################################################
 # askATT()
 #	receives: nothing
 #	outputs:  nothing
-#	function: Do everything to ask the MW for data and save it on globals 
-#	returns:  nothing
+#	function: Do everything to ask the MW for data and decode it
+#	returns:  Attitude record, or None if unavailable
 #############################################################
 def askATT():
-	#ser.flushInput()	# cleans out the serial port
-	#ser.flushOutput()
-	ser.write(MSP_RAW_IMU)	# sends MSP request
-	try:
-		error,cmd_resp=receiveData()
-	except Exception, error:
-		pass
-	#ATTITUDE(response)	# sends to ATTITUDE to parse and update global variables
+	return pollSweep(['MSP_ATTITUDE']).get('MSP_ATTITUDE')
 
 
 #############################################################
 # askRC()
 #	receives: nothing
 #	outputs:  nothing
-#	function: Do everything to ask the MW for data and save it on globals 
-#	returns:  nothing
+#	function: Do everything to ask the MW for data and decode it
+#	returns:  Rc record, or None if unavailable
 #############################################################
 def askRC():
-	#ser.flushInput()	# cleans out the serial port
-	#ser.flushOutput()
-	ser.write(MSP_RC)	# gets RC information
-	time.sleep(timeMSP)
-	response = ser.readline()
-	#while True:
-	#	response = ser.readline()
-	#	try:
-	#		if response[0] == '$':
-	#			break
-	#	except:
-	#		pass
-	RC(response)
+	return pollSweep(['MSP_RC']).get('MSP_RC')
 
 
 #############################################################
 # askALT()
 #	receives: nothing
 #	outputs:  nothing
-#	function: Do everything to ask the MW for data and save it on globals 
-#	returns:  nothing
+#	function: Do everything to ask the MW for data and decode it
+#	returns:  Altitude record, or None if unavailable
 #############################################################
 def askALT():
-	#ser.flushInput()	# cleans out the serial port
-	#ser.flushOutput()
-	ser.write(MSP_ALTITUDE)	# gets ALTITUDE data
-	while True:
-		response = ser.readline()
-		try:
-			if response[0] == '$':
-				break
-		except:
-			pass
-	ALTITUDE(response)
+	return pollSweep(['MSP_ALTITUDE']).get('MSP_ALTITUDE')
 
 
 #############################################################
 # askMOTOR()
 #   receives: nothing
 #   outputs:  nothing
-#   function: Do everything to ask the MW for data and save it on globals 
-#   returns:  nothing
+#   function: Do everything to ask the MW for data and decode it
+#   returns:  Motor record, or None if unavailable
 #############################################################
 def askMOTOR():
-	#ser.flushInput()	# cleans out the serial port
-	#ser.flushOutput()
-	ser.write(MSP_MOTOR) # gets motors data
-	while True:
-		response = ser.readline()
-		try:
-			if response[0] == '$':
-				break
-		except:
-			pass
-	MOTORS(response)
+	return pollSweep(['MSP_MOTOR']).get('MSP_MOTOR')
 
 
 #############################################################
 # askRAW()
 #   receives: nothing
 #   outputs:  nothing
-#   function: Do everything to ask the MW for data and save it on globals 
-#   returns:  nothing
+#   function: Do everything to ask the MW for data and decode it
+#   returns:  RawImu record, or None if unavailable
 #############################################################
 def askRAW():
-	#ser.flushInput()	# cleans out the serial port
-	#ser.flushOutput()
-	ser.write(MSP_RAW_IMU) # gets raw data
-	time.sleep(timeMSP)
-	response = ser.readline()
-	#while True:
-	#	response = ser.readline()
-	#	try:
-	#		if response[0] == '$':
-	#			break
-	#	except:
-	#		pass
-	RAW(response)
-
-
-#############################################################
-# getUDP()
-#   receives: nothing
-#   outputs:  nothing
-#   function: Receive, decode and print a udp packet data 
-#   returns:  nothing
+	return pollSweep(['MSP_RAW_IMU']).get('MSP_RAW_IMU')
+
+
+##########################################################################
+############################## Serial link ###############################
+##########################################################################
+# The serial link owns the serial port and publishes every decoded
+# answer into a thread safe store of latest values
+##########################################################################
+
 #############################################################
-def getUDP():
-	global udp_mess 
-	global udp_mess2
-	udp_mess=""
-	data, addr = sock.recvfrom(1024)
-	numOfValues = len(data) / 8
-	mess=struct.unpack('>' + 'd' * numOfValues, data)
-	for x in range(0, numOfValues):
-		udp_mess = udp_mess+" "+str(mess[x])
-	udp_mess2=udp_mess
+# monotonicNs()
+#	returns:  a monotonic clock in nanoseconds, CLOCK_MONOTONIC
+#		on linux, the default timer elsewhere
+#############################################################
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+	libc = ctypes.PyDLL(ctypes.util.find_library('c'))	# keeps the GIL, so one timespec is enough
+	clock_gettime = libc.clock_gettime
+	if not sys.platform.startswith('linux'):
+		raise OSError("CLOCK_MONOTONIC id unknown")
+	now_ts = timespec()
+	now_ts_ref = ctypes.byref(now_ts)
+	def monotonicNs():
+		clock_gettime(1, now_ts_ref)
+		return now_ts.tv_sec*1000000000 + now_ts.tv_nsec
+except (OSError, AttributeError, TypeError):
+	def monotonicNs():
+		return int(timeit.default_timer()*1e9)
 
 
 #############################################################
-# SetRC()
+# waitReadable(port, timeout)
+#	receives: serial port (or socket) and max time to wait
+#	function: sleeps until there is something to read
+#############################################################
+def waitReadable(port, timeout):
+	try:
+		select.select([port], [], [], timeout)
+	except (TypeError, ValueError, select.error):
+		time.sleep(timeout)
+
+
+#############################################################
+# waitReady(port, timeout, backoff)
+#	receives: opened serial port, longest wait in seconds (wakeUp
+#		by default) and the first wait for an answer
+#	function: asks MSP_IDENT, MSP_STATUS and MSP_RAW_IMU until the
+#		MW answers with valid frames, readyStatus answers in a
+#		row show a running loop (cycle time) and no new I2C
+#		errors, and the gyro calibration is over. MSP does not
+#		report the calibration, but MultiWii 2.3 sends the gyro
+#		as exactly 0 on every axis while it calibrates (the
+#		first 512 cycles), so the first reading with any axis
+#		not 0 ends it. The wait doubles (up to 1 s) while the
+#		board does not answer.
+#	returns:  (seconds it took, Ident record, Status record), or
+#		None if the board was not ready in time
+#############################################################
+def waitReady(port, timeout=None, backoff=0.05):
+	if timeout is None:
+		timeout = wakeUp
+	parser = MSPParser()
+	identCode = CMD2CODE['MSP_IDENT']
+	statusCode = CMD2CODE['MSP_STATUS']
+	imuCode = CMD2CODE['MSP_RAW_IMU']
+	start = monotonicNs()
+	deadline = start+int(timeout*1e9)
+	ident = status = None
+	good = 0		# good STATUS answers in a row
+	calibrated = False
+	delay = backoff
+	while monotonicNs() < deadline:
+		request = MSP_REQUESTS['MSP_STATUS']
+		if ident is None:
+			request = MSP_REQUESTS['MSP_IDENT']+request
+		if not calibrated:
+			request += MSP_REQUESTS['MSP_RAW_IMU']
+		port.write(request)
+		now = monotonicNs()
+		end = min(deadline, now+int(delay*1e9))
+		answered = False
+		while now < end:
+			waitReadable(port, (end-now)/1e9)
+			data = port.read(max(1, port.inWaiting()))
+			if data:
+				parser.feed(data)
+			for code, payload in parser:
+				record = decode(code, payload)
+				if record is None:
+					continue
+				answered = True
+				if code == identCode:
+					ident = record
+				elif code == statusCode:
+					if record.cycleTime and (status is None or record.i2c_errors == status.i2c_errors):
+						good += 1
+					else:
+						good = 0
+					status = record
+				elif code == imuCode:
+					calibrated = calibrated or bool(record.gx or record.gy or record.gz)
+			if ident is not None and good >= readyStatus and calibrated:
+				return ((monotonicNs()-start)/1e9, ident, status)
+			if answered:
+				break
+			now = monotonicNs()
+		delay = backoff if answered else min(2*delay, 1.0)
+	return None
+
+
+#############################################################
+# askRecords(port, names, timeout)
+#	receives: opened serial port, MSP names and how long to wait
+#	function: writes all the requests at once and collects the
+#		answers with its own parser, before the loop runs
+#	returns:  dictionary of MSP name -> raw values of the answers
+#		that arrived
+#############################################################
+def askRecords(port, names, timeout=0.5):
+	parser = MSPParser()
+	pending = set([CMD2CODE[name] for name in names])
+	answers = {}
+	port.write(''.join([MSP_REQUESTS[name] for name in names]))
+	deadline = monotonicNs()+int(timeout*1e9)
+	while pending:
+		now = monotonicNs()
+		if now >= deadline:
+			break
+		waitReadable(port, (deadline-now)/1e9)
+		data = port.read(max(1, port.inWaiting()))
+		if data:
+			parser.feed(data)
+		for code, payload in parser:
+			if code in pending:
+				raw = MSP_CODECS[code].unpack(payload)
+				if raw is not None:
+					answers[CODE2CMD[code]] = raw
+					pending.discard(code)
+	return answers
+
+
+# Messages that never change for one firmware build
+METADATA = ['MSP_BOXNAMES', 'MSP_PIDNAMES', 'MSP_BOXIDS', 'MSP_MOTOR_PINS']
+
+
+#############################################################
+# boardMetadata(port, ident, path)
+#	receives: opened serial port, the Ident record of the board
+#		(from waitReady) and the cache file
+#	function: the records of METADATA come from the cache when
+#		there is an entry for this firmware version, type, MSP
+#		version and capabilities. Otherwise they are asked to
+#		the board once and saved for the next start. A new
+#		firmware has a new identity, so its entry is fetched.
+#	returns:  (dictionary of MSP name -> record, True if it came
+#		from the cache)
+#############################################################
+def boardMetadata(port, ident, path=metadataCache):
+	key = "%d-%d-%d-%d" % (ident.version, ident.multitype, ident.msp_version, ident.capability)
+	cache = {}
+	try:
+		f = open(path)
+		cache = json.load(f)
+		f.close()
+	except (IOError, ValueError):
+		pass
+	entry = cache.get(key)
+	if entry is not None and all([name in entry for name in METADATA]):
+		records = {}
+		for name in METADATA:
+			raw = tuple([str(v) if isinstance(v, unicode) else v for v in entry[name]])	# json gives unicode names
+			records[name] = MSP_CODECS_BY_NAME[name].make(raw)
+		return records, True
+	answers = askRecords(port, METADATA)
+	if len(answers) == len(METADATA):
+		cache[key] = dict([(name, list(raw)) for name, raw in answers.items()])
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		f = open(path+".tmp", "w")
+		json.dump(cache, f, indent=1, sort_keys=True)
+		f.close()
+		os.rename(path+".tmp", path)	# never leaves a half written cache
+	return dict([(name, MSP_CODECS_BY_NAME[name].make(raw)) for name, raw in answers.items()]), False
+
+
+#############################################################
+# TelemetryStore()
+#	function: latest decoded record of each MSP message, keyed by
+#		MSP code. Every entry carries a sequence number and the
+#		monotonic time (ns) when it was received. Readers take
+#		snapshots and never touch the serial port.
+#############################################################
+TelemetryEntry = collections.namedtuple('TelemetryEntry', ['seq', 'stamp', 'record', 'raw'])
+
+class TelemetryStore(object):
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.entries = {}
+		self.seq = 0
+		self.stamp = 0	# arrival of the newest entry, the time of a sample for the sinks
+
+	def publish(self, code, record, raw, stamp):
+		with self.cond:
+			self.seq += 1
+			self.stamp = stamp
+			self.entries[code] = TelemetryEntry(self.seq, stamp, record, raw)
+			self.cond.notify_all()
+
+	# Latest entry of a MSP code, or None
+	def get(self, code):
+		return self.entries.get(code)
+
+	# Copy of all the latest entries
+	def snapshot(self):
+		with self.cond:
+			return dict(self.entries)
+
+	# Latest records keyed by MSP name
+	def records(self):
+		return dict([(CODE2CMD[code], entry.record) for code, entry in self.snapshot().items()])
+
+	# Waits until something newer than seq is published, returns the latest seq
+	def wait(self, seq, timeout):
+		with self.cond:
+			if self.seq <= seq:
+				self.cond.wait(timeout)
+			return self.seq
+
+
+#############################################################
+# mspBytes(name)
+#	receives: MSP name
+#	returns:  bytes of the request and of the answer on the wire
+#		(6 bytes of header, size, code and checksum + payload)
+#############################################################
+def mspBytes(name):
+	entry = msp_dict.get(name)
+	if entry is None:
+		return (6, 6)
+	return (6+entry[1], 6+entry[2])
+
+
+#############################################################
+# planRates(rates, baudrate, load, strict)
+#	receives: list of (MSP name, Hz) by priority, baud rate of the
+#		link, fraction of the link that can be used and if an
+#		impossible schedule is an error
+#	function: computes the bytes per second that the answers need
+#		(8N1 is 10 bits per byte). If they do not fit, the lowest
+#		priority messages are slowed down first, down to 0 Hz.
+#		Requests have no payload, so the answers are always the
+#		busiest direction.
+#	returns:  list of (MSP name, Hz) that the link can sustain
+#############################################################
+def planRates(rates, baudrate, load=0.8, strict=False):
+	capacity = baudrate/10.0*load
+	plan = [[name, float(hz)] for name, hz in rates]
+	excess = sum([hz*mspBytes(name)[1] for name, hz in plan]) - capacity
+	if excess <= 0:
+		return [tuple(entry) for entry in plan]
+	if strict:
+		raise ValueError("Schedule needs %d bytes/s more than the link has at %d baud" % (excess, baudrate))
+	for entry in reversed(plan):
+		if excess <= 0:
+			break
+		cost = mspBytes(entry[0])[1]
+		cut = min(entry[1]*cost, excess)
+		entry[1] -= cut/cost
+		excess -= cut
+	return [tuple(entry) for entry in plan]
+
+
+#############################################################
+# PollScheduler(rates, baudrate, load, strict)
+#	receives: same as planRates
+#	function: gives every message its own deadline and tells
+#		which ones are due. Missed deadlines are not caught up.
+#		When the answers are not arriving as fast as they are
+#		asked, the lowest priority messages are the ones shed.
+#		A plan with nothing to poll is a ValueError.
+#############################################################
+class PollScheduler(object):
+	def __init__(self, rates, baudrate, load=0.8, strict=False):
+		unknown = [name for name, hz in rates if name not in MSP_REQUESTS]
+		if unknown:
+			raise ValueError("Can not poll "+", ".join(unknown))
+		self.plan = planRates(rates, baudrate, load, strict)
+		self.names = [name for name, hz in self.plan if hz > 0]
+		if not self.names:
+			raise ValueError("Nothing to poll: no message with a rate above 0 Hz at %d baud" % baudrate)
+		self.periods = dict([(name, int(1e9/hz)) for name, hz in self.plan if hz > 0])
+		self.deadlines = dict([(name, 0) for name in self.names])
+		self.answerBytes = dict([(name, mspBytes(name)[1]) for name in self.names])
+		self.maxInflight = baudrate/10.0*timeSweep	# answer bytes that fit in one timeout
+		self.shed = dict([(name, 0) for name in self.names])
+		self.requests = {}
+
+	# Names due at time now (ns) by priority, within the bytes allowed in flight
+	def due(self, now, inflight=0):
+		names = []
+		for name in self.names:
+			if self.deadlines[name] > now:
+				continue
+			deadline = self.deadlines[name] + self.periods[name]
+			if deadline <= now:
+				deadline = now + self.periods[name]
+			self.deadlines[name] = deadline
+			if inflight + self.answerBytes[name] > self.maxInflight:
+				self.shed[name] += 1
+				continue
+			inflight += self.answerBytes[name]
+			names.append(name)
+		return names
+
+	# Requests of the names in one string, cached
+	def request(self, names):
+		key = tuple(names)
+		request = self.requests.get(key)
+		if request is None:
+			request = self.requests[key] = ''.join([MSP_REQUESTS[name] for name in names])
+		return request
+
+	# Seconds until the next deadline
+	def wait(self, now):
+		return max(0, min(self.deadlines.values())-now)/1e9
+
+
+#############################################################
+# SerialLink(port, store, names, pipelined, depth, timeout, scheduler)
+#	receives: serial port, TelemetryStore, MSP names to poll, if
+#		all of them are asked at once, how many sweeps to keep
+#		in flight, how long to wait for answers before asking
+#		again and an optional PollScheduler
+#	function: keeps the request pipeline full (or asks every
+#		message when the scheduler says it is due), feeds every
+#		byte received into its own parser and publishes the
+#		decoded answers in the store. onSweep is called every
+#		time a whole sweep of answers arrived, or with a
+#		scheduler every time the first message answers.
+#		Every request is tracked on its own: it is lost once an
+#		answer to a later request arrives (the MW answers in
+#		order) or after timeout, so a lost answer never holds
+#		the pipeline.
+#############################################################
+class SerialLink(object):
+	def __init__(self, port, store, names, pipelined=True, depth=2, timeout=timeSweep, scheduler=None):
+		self.port = port
+		self.store = store
+		self.parser = MSPParser()
+		self.scheduler = scheduler
+		if scheduler is not None:
+			names = scheduler.names
+			self.trigger = CMD2CODE[names[0]]
+		self.codes = set([CMD2CODE[name] for name in names])
+		self.answerBytes = dict([(CMD2CODE[name], mspBytes(name)[1]) for name in names])
+		self.inflight = 0		# answer bytes still expected (with a scheduler)
+		if scheduler is not None:
+			self.batches = []
+			self.threshold = 0
+		elif pipelined and names:
+			self.batches = [(''.join([MSP_REQUESTS[name] for name in names]), [CMD2CODE[name] for name in names])]
+			self.threshold = len(names)*(depth-1)
+		else:
+			self.batches = [(MSP_REQUESTS[name], [CMD2CODE[name]]) for name in names]
+			self.threshold = 0
+		self.next = 0
+		self.timeout = int(timeout*1e9)
+		self.sent = dict([(code, collections.deque()) for code in self.codes])	# write time of every request waiting
+		self.outstanding = 0	# answers still expected
+		self.answers = 0		# answers received
+		self.lost = 0			# requests that got no answer
+		self.onSweep = None
+
+	def request(self, request, codes, now):
+		self.port.write(request)
+		for code in codes:
+			self.sent[code].append(now)
+			self.inflight += self.answerBytes[code]
+		self.outstanding += len(codes)
+
+	# Forgets the requests of code sent before a time
+	def expire(self, code, before):
+		sent = self.sent[code]
+		while sent and sent[0] < before:
+			sent.popleft()
+			self.outstanding -= 1
+			self.inflight = max(0, self.inflight-self.answerBytes[code])
+			self.lost += 1
+
+	# Writes requests until the pipeline is full
+	def pump(self, now):
+		while self.batches and self.outstanding <= self.threshold:
+			request, codes = self.batches[self.next]
+			self.next = (self.next+1) % len(self.batches)
+			self.request(request, codes, now)
+
+	# Called periodically, forgets the requests that timed out and asks the
+	# messages that are due. Returns the seconds until the next call.
+	def tick(self):
+		now = monotonicNs()
+		oldest = now
+		if self.outstanding:
+			for code in self.sent:
+				self.expire(code, now-self.timeout)
+				if self.sent[code]:
+					oldest = min(oldest, self.sent[code][0])
+		wait = (oldest+self.timeout-now)/1e9	# until the oldest request times out
+		scheduler = self.scheduler
+		if scheduler is None:
+			self.pump(now)
+			return wait
+		names = scheduler.due(now, self.inflight)
+		if names:
+			self.request(scheduler.request(names), [CMD2CODE[name] for name in names], now)
+		return min(wait, scheduler.wait(now))
+
+	# Called when the serial port has something to read
+	def onReadable(self):
+		port = self.port
+		data = port.read(max(1, port.inWaiting()))
+		if not data:
+			return
+		stamp = monotonicNs()
+		self.parser.feed(data)
+		store = self.store
+		for code, payload in self.parser:
+			codec = MSP_CODECS.get(code)
+			if codec is None:
+				continue
+			raw = codec.unpack(payload)
+			if raw is None:
+				continue
+			store.publish(code, codec.make(raw), raw, stamp)
+			if code in self.codes:
+				sent = self.sent[code]
+				if sent:
+					asked = sent.popleft()
+					self.outstanding -= 1
+					self.inflight = max(0, self.inflight-self.answerBytes[code])
+					for other in self.sent:
+						if self.sent[other] and self.sent[other][0] < asked:
+							self.expire(other, asked)	# asked before, so never answered
+				self.answers += 1
+				if self.onSweep is not None:
+					if self.scheduler is not None:
+						if code == self.trigger:
+							self.onSweep()
+					elif self.answers % len(self.codes) == 0:
+						self.onSweep()
+		self.pump(stamp)
+
+
+##########################################################################
+############################### Event loop ###############################
+##########################################################################
+# One select() based loop runs the serial link, the UDP endpoint, the
+# poll timers and the sinks, one callback at a time
+##########################################################################
+
+#############################################################
+# EventLoop()
+#	function: calls the reader of every registered file (serial
+#		port, sockets) when it has something to read and the
+#		timers when they are due. Timers due at the same time
+#		run in the order they were added.
+#############################################################
+class EventLoop(object):
+	def __init__(self):
+		self.readers = {}	# fileno -> callback
+		self.timers = []	# heap of [deadline ns, order, period ns, callback]
+		self.order = 0
+		self.running = False
+
+	def addReader(self, source, callback):
+		self.readers[source.fileno()] = callback
+
+	def removeReader(self, source):
+		self.readers.pop(source.fileno(), None)
+
+	# Calls callback every period seconds (or once if period is None), returns the timer
+	def addTimer(self, period, callback, delay=0):
+		self.order += 1
+		if period is not None:
+			period = int(period*1e9)
+		timer = [monotonicNs()+int(delay*1e9), self.order, period, callback]
+		heapq.heappush(self.timers, timer)
+		return timer
+
+	def callLater(self, delay, callback):
+		return self.addTimer(None, callback, delay)
+
+	def cancel(self, timer):
+		timer[3] = None
+
+	def runTimers(self):
+		timers = self.timers
+		now = monotonicNs()
+		while timers and timers[0][0] <= now:
+			timer = heapq.heappop(timers)
+			callback = timer[3]
+			if callback is None:
+				continue
+			if timer[2] is not None:
+				timer[0] = max(timer[0]+timer[2], now)	# no burst to catch up
+				heapq.heappush(timers, timer)
+			callback()
+		if timers:
+			return max(0, timers[0][0]-monotonicNs())/1e9
+		return None
+
+	def run(self):
+		self.running = True
+		while self.running:
+			timeout = self.runTimers()
+			if not self.running:
+				break
+			fds = sorted(self.readers.keys())
+			try:
+				ready = select.select(fds, [], [], timeout)[0]
+			except select.error, error:
+				if error.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd in ready:
+				callback = self.readers.get(fd)
+				if callback is not None:
+					callback()
+
+	def stop(self):
+		self.running = False
+
+
+##########################################################################
+################################ Transmit ################################
+##########################################################################
+# Everything written to the MW goes through one queue with priorities
+##########################################################################
+
+TX_CONTROL = 0		# RC commands
+TX_TELEMETRY = 1	# polling of the telemetry
+TX_BULK = 2			# parameters and anything else
+TX_CLASSES = ['control', 'telemetry', 'bulk']
+TX_COMMANDS = {'MSP_SET_RAW_RC': TX_CONTROL, 'MSP_SET_RAW_GPS': TX_CONTROL}	# class of the commands, the others are bulk
+
+tx_ports = None	# ClassPort of every class of the TransmitQueue of main(), None writes straight to ser
+
+
+#############################################################
+# TransmitQueue(port, loop, baudrate, shares, slack)
+#	receives: serial port, EventLoop, baud rate, share of the
+#		link reserved for every class and the seconds of bytes
+#		that can wait in the serial driver
+#	function: one queue per class. Bytes are only handed to the
+#		driver when what it already has goes out in less than
+#		slack, so a new RC command never waits behind a pile of
+#		telemetry. The next write is the first class (by
+#		priority) with the head frame within its reservation
+#		(token bucket of its share), then the first class with
+#		anything queued. Control frames of the same command
+#		replace each other, only the latest setpoint is sent.
+#		A frame can come with a function called with the time
+#		it is written to the port. Keeps the depth, the wait
+#		(Histogram, ns), the bytes and the frames coalesced of
+#		every class.
+#############################################################
+class TransmitQueue(object):
+	def __init__(self, port, loop, baudrate=None, shares=txShares, slack=txSlack):
+		self.port = port
+		self.loop = loop
+		self.rate = (baudrate or port.baudrate)/10.0	# bytes per second
+		self.shares = shares
+		self.slack = int(slack*1e9)
+		self.queues = [collections.deque() for c in TX_CLASSES]
+		self.tokens = [0.0]*len(TX_CLASSES)
+		self.burst = [max(64, share*self.rate*0.05) for share in shares]
+		self.keys = {}			# key -> item waiting, for coalescing
+		self.refilled = monotonicNs()
+		self.busyUntil = 0		# when the bytes given to the driver are out
+		self.timer = None
+		self.waits = [Histogram() for c in TX_CLASSES]
+		self.sent = [0]*len(TX_CLASSES)		# bytes
+		self.coalesced = [0]*len(TX_CLASSES)
+
+	# Queues data of a class, frames with the same key replace each other
+	# (and their done). done(now) is called when the data is written.
+	def submit(self, klass, data, key=None, done=None):
+		now = monotonicNs()
+		if key is not None:
+			item = self.keys.get(key)
+			if item is not None:
+				item[0] = str(data)
+				item[1] = now
+				item[3] = done
+				self.coalesced[klass] += 1
+				return len(data)
+		if not any(self.queues) and self.busyUntil-now <= self.slack:
+			self.transmit(klass, data, now, now, done)	# nothing to wait for, no copy
+			return len(data)
+		item = [str(data), now, key, done]	# the caller may reuse its buffer
+		self.queues[klass].append(item)
+		if key is not None:
+			self.keys[key] = item
+		self.service()
+		return len(data)
+
+	def transmit(self, klass, data, stamp, now, done=None):
+		self.port.write(data)
+		if done is not None:
+			done(now)
+		n = len(data)
+		self.busyUntil = max(self.busyUntil, now)+int(n*1e9/self.rate)
+		self.tokens[klass] = max(0.0, self.tokens[klass]-n)
+		self.sent[klass] += n
+		self.waits[klass].add(now-stamp)
+
+	# Writes what the driver can take now, then waits for the wire
+	def service(self):
+		self.timer = None
+		now = monotonicNs()
+		elapsed = (now-self.refilled)/1e9
+		self.refilled = now
+		for c, share in enumerate(self.shares):
+			self.tokens[c] = min(self.burst[c], self.tokens[c]+share*self.rate*elapsed)
+		queues = self.queues
+		while any(queues):
+			if self.busyUntil-now > self.slack:
+				if self.timer is None:
+					self.timer = self.loop.callLater((self.busyUntil-now-self.slack)/1e9, self.service)
+				return
+			klass = None
+			for c, queue in enumerate(queues):
+				if queue and self.tokens[c] >= len(queue[0][0]):
+					klass = c
+					break
+			if klass is None:
+				klass = [c for c, queue in enumerate(queues) if queue][0]
+			data, stamp, key, done = queues[klass].popleft()
+			if key is not None:
+				del self.keys[key]
+			self.transmit(klass, data, stamp, now, done)
+
+	def depth(self, klass):
+		return len(self.queues[klass])
+
+	def report(self):
+		lines = ["%-10s %6s %9s %10s %10s %10s %10s" % ("class", "depth", "bytes", "coalesced", "p50 (ms)", "p99 (ms)", "max (ms)")]
+		for c, name in enumerate(TX_CLASSES):
+			h = self.waits[c]
+			lines.append("%-10s %6d %9d %10d %10.2f %10.2f %10.2f" % (name, len(self.queues[c]), self.sent[c], self.coalesced[c], h.percentile(0.5)/1e6, h.percentile(0.99)/1e6, h.max/1e6))
+		return "\n".join(lines)
+
+
+#############################################################
+# ClassPort(queue, klass, coalesce)
+#	receives: TransmitQueue, the class of the writes and if
+#		frames of the same MSP code replace each other
+#	function: serial port for one kind of traffic, writes go
+#		through the queue, everything else to the port
+#############################################################
+
+class ClassPort(object):
+	def __init__(self, queue, klass, coalesce=False):
+		self.queue = queue
+		self.klass = klass
+		self.coalesce = coalesce
+
+	def write(self, data, done=None):
+		key = None
+		if self.coalesce and len(data) > 4:
+			code = data[4]
+			if isinstance(code, str):
+				code = ord(code)
+			key = (self.klass, code)
+		return self.queue.submit(self.klass, data, key, done)
+
+	def __getattr__(self, name):
+		return getattr(self.queue.port, name)
+
+
+#############################################################
+# classPorts(queue)
+#	receives: TransmitQueue
+#	returns:  a ClassPort per class, in the order of TX_CLASSES
+#		(control frames replace each other)
+#############################################################
+def classPorts(queue):
+	return [ClassPort(queue, klass, klass == TX_CONTROL) for klass in range(len(TX_CLASSES))]
+
+
+##########################################################################
+################################ Control #################################
+##########################################################################
+# RC commands sent to the MW
+##########################################################################
+
+#############################################################
+# clampRC(values, channels)
+#	receives: commands (any number, in the order of rcFailsafe)
+#		and the list of channels to fill
+#	function: rounds every command to a PWM between rcMin and
+#		rcMax. Missing or invalid (NaN) commands take the
+#		failsafe value of their channel.
+#	returns:  channels
+#############################################################
+def clampRC(values, channels):
+	for i in range(len(channels)):
+		v = values[i] if i < len(values) else None
+		if v is None or v != v:
+			channels[i] = rcFailsafe[i]
+		else:
+			channels[i] = int(round(min(rcMax, max(rcMin, v))))
+	return channels
+
+
+#############################################################
+# setRC()
 #   receives: nothing
 #   outputs:  nothing
-#   function: Sends RC raw data to Multiwii 
-#   returns:  nothing
+#   function: Sends the RC commands in rcData to the MultiWii
+#   returns:  bytes written, None on errors
 #############################################################
 def setRC():
-	rcData = [ int(x) for x in rcData ]
-	print rcData
+	return sendCommand('MSP_SET_RAW_RC', clampRC(rcData, list(rcFailsafe)))
+
+
+#############################################################
+# ControlBridge(udp, port, timeout)
+#	receives: UDPEndpoint with the commands, serial port and the
+#		seconds a command is valid
+#	function: called by a timer of the event loop at rcRate, sends
+#		the latest UDP command (clamped) as MSP_SET_RAW_RC, or
+#		the failsafe values when no packet arrived for timeout
+#		seconds. When the UDP fields are named the channels are
+#		taken by name (roll, pitch, yaw, throttle, aux1-4) and
+#		the ones missing get their failsafe value, otherwise
+#		by position. latency keeps the time (ns) from the arrival of
+#		every packet to the write of its command to the serial
+#		port (through the transmit queue with a ClassPort).
+#############################################################
+class ControlBridge(object):
+	def __init__(self, udp, port, timeout=rcTimeout):
+		self.udp = udp
+		self.port = port
+		self.command = commandFrame('MSP_SET_RAW_RC')
+		self.timeout = int(timeout*1e9)
+		self.channels = list(rcFailsafe)
+		self.indexes = None	# index of every channel in the UDP fields, None when missing
+		if udp.fields:
+			names = MSP_CODECS_BY_NAME['MSP_SET_RAW_RC'].fields
+			self.indexes = [udp.fields.index(name) if name in udp.fields else None for name in names]
+			if not [i for i in self.indexes if i is not None]:
+				print "No RC channel in the UDP fields, only the failsafe values will be sent"
+		self.stamp = 0		# arrival of the last packet sent
+		self.stale = True
+		self.latency = Histogram()
+		self.sent = 0
+		self.failsafes = 0	# commands sent with the failsafe values
+
+	def __call__(self):
+		udp = self.udp
+		fresh = False
+		if udp.values is None or monotonicNs() - udp.stamp > self.timeout:
+			if not self.stale:
+				print "RC failsafe: no UDP commands for "+str(self.timeout/1e9)+" s"
+				self.stale = True
+			self.channels[:] = rcFailsafe
+			self.failsafes += 1
+		else:
+			if self.stale:
+				print "RC commands from UDP"
+				self.stale = False
+			if udp.stamp != self.stamp:
+				values = udp.values
+				if self.indexes is not None:
+					values = [None if i is None else values[i] for i in self.indexes]
+				clampRC(values, self.channels)
+				fresh = True
+		done = None
+		if fresh and isinstance(self.port, ClassPort):
+			done = lambda now, stamp=udp.stamp: self.latency.add(now-stamp)
+		if self.command.send(self.port, self.channels, done) is None:
+			return
+		self.sent += 1
+		if fresh:
+			self.stamp = udp.stamp
+			if done is None:
+				self.latency.add(monotonicNs()-udp.stamp)
+
+	def report(self):
+		h = self.latency
+		return "RC commands sent: %d (%d failsafe), UDP to serial latency p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (self.sent, self.failsafes, h.percentile(0.5)/1e6, h.percentile(0.99)/1e6, h.max/1e6)
+
+
+##########################################################################
+############################### Profiling ################################
+##########################################################################
+# Optional timing of every stage of the loop. When it is off nothing is
+# wrapped, so it costs nothing.
+##########################################################################
+
+#############################################################
+# Histogram()
+#	function: fixed memory histogram of times in ns. Buckets are
+#		log spaced, 4 per power of two (under 19% error), so
+#		add() is a few integer operations.
+#############################################################
+class Histogram(object):
+	def __init__(self):
+		self.buckets = [0]*256
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def add(self, ns):
+		if ns < 0:
+			ns = 0
+		if ns < 8:
+			i = ns
+		else:
+			bits = ns.bit_length()
+			i = 8 + (bits-4)*4 + ((ns >> (bits-3)) & 3)
+		self.buckets[min(i, 255)] += 1
+		self.count += 1
+		self.total += ns
+		if ns > self.max:
+			self.max = ns
+
+	# Upper bound of the bucket with the p (0 to 1) percentile
+	def percentile(self, p):
+		if not self.count:
+			return 0
+		target = p*self.count
+		seen = 0
+		for i, n in enumerate(self.buckets):
+			seen += n
+			if n and seen >= target:
+				if i < 8:
+					return i
+				bits = (i-8)//4 + 4
+				return min(self.max, (5 + (i-8) % 4) << (bits-3))
+		return self.max
+
+
+#############################################################
+# Profiler()
+#	function: one histogram per stage, a report of all of them
+#		and helpers to time functions and serial ports
+#############################################################
+class Profiler(object):
+	def __init__(self):
+		self.stages = collections.OrderedDict()
+
+	def histogram(self, stage):
+		histogram = self.stages.get(stage)
+		if histogram is None:
+			histogram = self.stages[stage] = Histogram()
+		return histogram
+
+	# Wraps function so every call is added to the histogram of stage
+	def timed(self, stage, function):
+		add = self.histogram(stage).add
+		def call(*args, **kwargs):
+			start = monotonicNs()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				add(monotonicNs()-start)
+		return call
+
+	def report(self):
+		lines = ["%-22s %9s %10s %10s %10s" % ("stage", "count", "p50 (us)", "p99 (us)", "max (us)")]
+		for stage, h in self.stages.items():
+			if not h.count:
+				continue
+			lines.append("%-22s %9d %10.1f %10.1f %10.1f" % (stage, h.count, h.percentile(0.5)/1e3, h.percentile(0.99)/1e3, h.max/1e3))
+		return "\n".join(lines)
+
+
+#############################################################
+# ProfiledPort(port, profiler)
+#	receives: serial port and Profiler
+#	function: times writes and reads, and remembers when every
+#		request was written so the wait for its answer can be
+#		timed when it is published
+#############################################################
+class ProfiledPort(object):
+	def __init__(self, port, profiler, timeout=timeSweep):
+		self.port = port
+		self.timeout = int(timeout*1e9)
+		self.parser = MSPParser('<')
+		self.sent = collections.defaultdict(collections.deque)
+		self.write_h = profiler.histogram('serial write')
+		self.read_h = profiler.histogram('serial read')
+		self.wait_h = profiler.histogram('response wait')
+
+	def write(self, data):
+		start = monotonicNs()
+		n = self.port.write(data)
+		self.write_h.add(monotonicNs()-start)
+		self.parser.feed(data)
+		for code, payload in self.parser:
+			self.sent[code].append(start)
+		return n
+
+	def read(self, size=1):
+		start = monotonicNs()
+		data = self.port.read(size)
+		self.read_h.add(monotonicNs()-start)
+		return data
+
+	# Adds the time since the request of code to the answer at stamp
+	def answered(self, code, stamp):
+		sent = self.sent[code]
+		while sent and stamp - sent[0] > self.timeout:
+			sent.popleft()	# lost
+		if sent:
+			self.wait_h.add(stamp-sent.popleft())
+
+	def inWaiting(self):
+		return self.port.inWaiting()
+
+	def fileno(self):
+		return self.port.fileno()
+
+
+#############################################################
+# instrument(profiler, link, sinks, writer)
+#	receives: Profiler, SerialLink, list of sinks and LogWriter
+#		(or None)
+#	function: wraps every stage of the loop with timing: serial
+#		write, wait for the answer, serial read, decoding, each
+#		sink, the file writes, the whole sweep and the ask*()
+#		and receiveData() helpers
+#	returns:  the list of sinks to use
+#############################################################
+def instrument(profiler, link, sinks, writer=None):
+	port = ProfiledPort(link.port, profiler)
+	link.port = port
+	publish = link.store.publish
+	def answered(code, record, raw, stamp):
+		port.answered(code, stamp)
+		publish(code, record, raw, stamp)
+	link.store.publish = answered
+	link.onReadable = profiler.timed('serial service', link.onReadable)
+	for codec in MSP_CODECS.values():
+		codec.unpack = profiler.timed('decode unpack', codec.unpack)
+		codec.make = profiler.timed('decode record', codec.make)
+	if writer is not None:
+		writer.writeChunks = profiler.timed('file write', writer.writeChunks)
+	for name in ['receiveData', 'pollSweep', 'askATT', 'askRC', 'askALT', 'askMOTOR', 'askRAW']:
+		globals()[name] = profiler.timed(name, globals()[name])
+	sweep = profiler.histogram('sweep')
+	last = [0]
+	def sweepTime():
+		now = monotonicNs()
+		if last[0]:
+			sweep.add(now-last[0])
+		last[0] = now
+	return [sweepTime]+[profiler.timed('sink '+sink.__class__.__name__, sink) for sink in sinks]
+
+
+#############################################################
+# startProfiler()
+#	function: creates the Profiler, prints its report on
+#		SIGUSR1 and when the program exits
+#	returns:  the Profiler
+#############################################################
+def startProfiler():
+	profiler = Profiler()
+	def show(*args):
+		print profiler.report()
+		if command_frames:
+			print commandReport()
+	if hasattr(signal, 'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, show)
+	atexit.register(show)
+	return profiler
+
+
+##########################################################################
+################################# Sinks ##################################
+##########################################################################
+# Consumers of the telemetry, called by the serial link after a sweep
+##########################################################################
+
+# drone flags, the MSP message and the fields of it that are logged, in the order of the log
+LOG_FIELDS = [
+	('ATT', 'MSP_ATTITUDE', ['angx', 'angy', 'heading']),
+	('RC', 'MSP_RC', ['roll', 'pitch', 'yaw', 'throttle']),
+	('ALT', 'MSP_ALTITUDE', ['altitude']),
+	('MOT', 'MSP_MOTOR', ['m1', 'm2', 'm3', 'm4']),
+	('RAW', 'MSP_RAW_IMU', ['ax', 'ay', 'az', 'gx', 'gy', 'gz', 'magx', 'magy', 'magz']),
+]
+
+LOG_MAGIC = "RPIMW-BIN 1\n"
+
+
+#############################################################
+# structTypes(fmt)
+#	receives: a struct format like '<ih' or '<8H'
+#	returns:  the list of type characters, one per value
+#############################################################
+def structTypes(fmt):
+	types = []
+	for count, char in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+		types.extend([char]*int(count or 1))
+	return types
+
+
+#############################################################
+# LogLayout(mocap)
+#	receives: names of the merged mocap doubles (None for none)
+#	function: the channels selected in the drone class, with the
+#		type they have on the wire and their scale factor, then
+#		the mocap doubles, and a precompiled struct for one
+#		binary record (monotonic ns timestamp followed by the
+#		raw values)
+#############################################################
+class LogLayout(object):
+	def __init__(self, mocap=None):
+		self.channels = []
+		self.messages = []	# (code, field indexes, empty raw, empty record)
+		types = []
+		for flag, name, fields in LOG_FIELDS:
+			if not getattr(drone, flag):
+				continue
+			codec = MSP_CODECS_BY_NAME[name]
+			codecTypes = structTypes(codec.struct.format)
+			indexes = [codec.fields.index(field) for field in fields]
+			self.messages.append((codec.code, indexes, (0,)*len(codec.fields), codec.empty))
+			for i in indexes:
+				scale = None
+				if codec.scaled:
+					scale = codec.scales[i]
+				self.channels.append({'name': codec.fields[i], 'msp': name, 'type': codecTypes[i], 'scale': scale, 'offset': codec.offsets[i]})
+				types.append(codecTypes[i])
+		self.mocap = list(mocap or [])
+		for name in self.mocap:
+			self.channels.append({'name': name, 'msp': None, 'type': 'd', 'scale': None, 'offset': 0.})
+			types.append('d')
+		self.nan = [float('nan')]*len(self.mocap)
+		self.struct = struct.Struct('<q'+''.join(types))
+
+	# Values of the channels from a store snapshot, raw or as in the records,
+	# and the mocap values (NaN while there are none)
+	def values(self, entries, raw=False, mocap=None):
+		values = []
+		for code, indexes, emptyRaw, emptyRecord in self.messages:
+			entry = entries.get(code)
+			if entry is None:
+				data = emptyRaw if raw else emptyRecord
+			else:
+				data = entry.raw if raw else entry.record
+			values.extend([data[i] for i in indexes])
+		if self.mocap:
+			values.extend(self.nan if mocap is None else mocap)
+		return values
+
+	# Header written at the beginning of a binary log
+	def header(self, start):
+		return LOG_MAGIC + json.dumps({
+			'record': self.struct.format,
+			'size': self.struct.size,
+			'start_ns': start,
+			'start_time': time.time(),
+			'time': drone.TIME,
+			'flyt': drone.FLYT,
+			'precision': precision,
+			'channels': self.channels}) + "\n"
+
+
+#############################################################
+# MocapMerge(store, udp, mode, maxAge)
+#	receives: TelemetryStore, UDPEndpoint, how the mocap samples
+#		are aligned ('interpolate' or 'hold') and the seconds a
+#		mocap sample is valid
+#	function: streaming join of the MSP telemetry and the mocap
+#		packets, both stamped when they arrived. Called as a
+#		sink after every sweep, it queues the sweep at the
+#		time of its newest answer. Once a mocap packet newer
+#		than that time arrived (or maxAge passed) the mocap
+#		values are interpolated between the two packets around
+#		it (or the last one is held) and onMerged is called.
+#		While it runs, snapshot() returns the entries of that
+#		sweep, values the aligned mocap (NaN when no packet
+#		is closer than maxAge, or none arrived yet but the
+#		fields or the packet length are known) and stamp the
+#		time of the sweep,
+#		so it replaces the store and the UDP endpoint of the
+#		sinks. Memory is bounded by mocapSamples.
+#############################################################
+class MocapMerge(object):
+	def __init__(self, store, udp, mode=mocapMerge, maxAge=mocapMaxAge):
+		self.store = store
+		self.udp = udp
+		self.fields = udp.fields
+		self.width = len(udp.fields) if udp.fields else 0	# doubles per packet, once known
+		self.interpolate = mode == 'interpolate'
+		self.maxAge = int(maxAge*1e9)
+		self.samples = collections.deque(maxlen=mocapSamples)	# (stamp, values) of the mocap
+		self.pending = collections.deque()	# (stamp, entries) of the sweeps waiting for the mocap
+		self.entries = {}
+		self.values = None
+		self.stamp = 0	# time of the merged sweep
+		self.age = None	# ns between the sweep and the closest mocap sample
+		self.dropped = 0	# sweeps that waited too long in a full queue
+		self.onMerged = None
+		udp.onPacket = self.onPacket
+
+	def snapshot(self):
+		return self.entries
+
+	# Sink called after every sweep
+	def __call__(self):
+		entries = self.store.snapshot()
+		stamp = max([entry.stamp for entry in entries.values()] or [0])
+		if len(self.pending) >= mocapSamples:
+			self.pending.popleft()
+			self.dropped += 1
+		self.pending.append((stamp, entries))
+		self.flush(monotonicNs())
+
+	def onPacket(self, stamp, values):
+		self.width = len(values)
+		self.samples.append((stamp, values))
+		self.flush(stamp)
+
+	# Merges the sweeps that can not get a better mocap sample any more
+	def flush(self, now):
+		newest = self.samples[-1][0] if self.samples else 0
+		pending = self.pending
+		while pending:
+			stamp, entries = pending[0]
+			if self.interpolate and newest < stamp and now-stamp <= self.maxAge:
+				return
+			pending.popleft()
+			self.merge(stamp, entries)
+
+	def merge(self, stamp, entries):
+		values, age = self.sampleAt(stamp)
+		if values is not None and age > self.maxAge:
+			values = self.make([float('nan')]*len(values))
+		elif values is None and self.width:
+			values = self.make([float('nan')]*self.width)	# the columns stay in place
+		self.entries = entries
+		self.values = values
+		self.stamp = stamp
+		self.age = age
+		if self.onMerged is not None:
+			self.onMerged()
+
+	# Mocap values at time t and the ns to the closest sample used
+	def sampleAt(self, t):
+		after = None
+		for stamp, values in reversed(self.samples):
+			if stamp <= t:
+				if after is None or not self.interpolate:
+					return values, t-stamp
+				s1, v1 = after
+				w = float(t-stamp)/(s1-stamp)
+				return self.make([a+(b-a)*w for a, b in zip(values, v1)]), min(t-stamp, s1-t)
+			after = (stamp, values)
+		if after is not None:
+			return after[1], after[0]-t	# older than every sample kept
+		return None, None
+
+	def make(self, values):
+		record = self.udp.record
+		if record is None:
+			return tuple(values)
+		return record._make(values)
+
+
+#############################################################
+# LineSink(store, udp, file)
+#	receives: TelemetryStore, UDPEndpoint (or None) and file
+#		(or None). A MocapMerge can take the place of both
+#		the store and the UDP endpoint.
+#	function: builds a line with the data selected in the drone
+#		class, prints it and/or saves it in the file. The times
+#		are those of the samples (the stamp of the store), not
+#		of the call.
+#############################################################
+class LineSink(object):
+	def __init__(self, store, udp=None, file=None):
+		self.store = store
+		self.udp = udp
+		self.file = file
+		self.layout = LogLayout()
+		self.flytime = self.last = monotonicNs()
+
+	def __call__(self):
+		now = self.store.stamp or monotonicNs()
+		diff = (now - self.last)/1e9
+		elapsed = (now - self.flytime)/1e9
+		self.last = now
+		entries = self.store.snapshot()
+		if drone.ALT and CMD2CODE['MSP_ALTITUDE'] not in entries:
+			return	# Won't send any data until altitude is valid data
+		#Start adding all data to a variable
+		parts = []
+		if drone.TIME:
+			parts.append(str(round(diff,precision)))
+		#Save elapsed time
+		if drone.FLYT:
+			parts.append(str(round(elapsed,precision)))
+		#save the selected messages
+		parts.extend(map(str, self.layout.values(entries)))
+		message = " ".join(parts)
+		#save udp, NaN until the first packet when the fields are known
+		if self.udp is not None:
+			values = self.udp.values
+			if values is None and self.udp.fields:
+				values = [float('nan')]*len(self.udp.fields)
+			if values is not None:
+				message = message+" "+" ".join(map(str, values))
+		#print to terminal
+		if drone.PRINT:
+			print(message)
+		# print in CSV file
+		if self.file is not None:
+			self.file.write(message+"\n")
+
+
+#############################################################
+# BinarySink(store, file, mocap)
+#	receives: TelemetryStore, a LogWriter not started yet and a
+#		MocapMerge with named fields (or None)
+#	function: sets the header of the log and then writes one fixed
+#		size little endian record per sweep, stamped with the
+#		time of the sample. The merged mocap doubles follow the
+#		MSP channels; without a merge UDP data is not part of
+#		the binary log.
+#############################################################
+class BinarySink(object):
+	def __init__(self, store, file, mocap=None):
+		self.store = store
+		self.file = file
+		self.mocap = mocap
+		self.layout = LogLayout(mocap.fields if mocap is not None else None)
+		self.pack = self.layout.struct.pack
+		self.file.setHeader(self.layout.header(monotonicNs()))
+
+	def __call__(self):
+		stamp = self.store.stamp or monotonicNs()
+		entries = self.store.snapshot()
+		if drone.ALT and CMD2CODE['MSP_ALTITUDE'] not in entries:
+			return
+		mocap = self.mocap.values if self.mocap is not None else None
+		self.file.write(self.pack(stamp, *self.layout.values(entries, True, mocap)))
+
+
+#############################################################
+# TelemetryHistory(store, seconds, rate)
+#	receives: TelemetryStore, seconds of history to keep and the
+#		expected samples per second
+#	function: keeps the last samples of the logged channels in
+#		preallocated numpy arrays, one column per channel plus
+#		the monotonic timestamps (ns) of the samples. Every sample is written
+#		twice, capacity rows apart, so the latest n samples are
+#		always one contiguous slice and window() returns views
+#		without copying. Memory never grows. Works as a sink.
+#############################################################
+class TelemetryHistory(object):
+	def __init__(self, store, seconds=historySeconds, rate=historyRate):
+		if numpy is None:
+			raise ImportError("TelemetryHistory needs numpy")
+		self.store = store
+		self.layout = LogLayout()
+		self.names = [channel['name'] for channel in self.layout.channels]
+		self.capacity = int(seconds*rate)
+		self.stamps = numpy.zeros(2*self.capacity, dtype=numpy.int64)
+		self.data = numpy.zeros((2*self.capacity, len(self.names)), dtype=numpy.float64)
+		self.index = 0	# row of the next sample
+		self.count = 0	# samples kept
+
+	def __call__(self):
+		self.append(self.store.stamp or monotonicNs(), self.layout.values(self.store.snapshot()))
+
+	def append(self, stamp, values):
+		i = self.index
+		j = i+self.capacity
+		self.stamps[i] = self.stamps[j] = stamp
+		self.data[i] = self.data[j] = values
+		self.index = (i+1) % self.capacity
+		if self.count < self.capacity:
+			self.count += 1
+
+	# Views of the timestamps and the channels of the last n samples (all by default)
+	def last(self, n=None):
+		if n is None or n > self.count:
+			n = self.count
+		end = self.index+self.capacity
+		return self.stamps[end-n:end], self.data[end-n:end]
+
+	# Views of the samples of the last seconds
+	def window(self, seconds):
+		stamps, data = self.last()
+		if not len(stamps):
+			return stamps, data
+		start = numpy.searchsorted(stamps, stamps[-1]-int(seconds*1e9))
+		return stamps[start:], data[start:]
+
+	# View of one channel of the last n samples
+	def channel(self, name, n=None):
+		return self.last(n)[1][:, self.names.index(name)]
+
+	# Saves the history as a .npy structured array or as a CSV file
+	def save(self, path):
+		stamps, data = self.last()
+		if path.endswith(".npy"):
+			table = numpy.zeros(len(stamps), dtype=[('stamp', numpy.int64)]+[(name, numpy.float64) for name in self.names])
+			table['stamp'] = stamps
+			for i, name in enumerate(self.names):
+				table[name] = data[:, i]
+			numpy.save(path, table)
+		else:
+			table = numpy.column_stack(((stamps-stamps[0])/1e9 if len(stamps) else stamps, data))
+			numpy.savetxt(path, table, fmt='%.6g', header=" ".join(['time']+self.names), comments='')
+
+
+#############################################################
+# LogWriter(directory, suffix, queueSize, policy, batch, fsync,
+#	rotateBytes, rotateSeconds)
+#	receives: where the files go and their extension, how many
+#		writes can wait in the queue, what to do when it is full
+#		('drop-oldest', 'drop-newest' or 'block'), how many
+#		writes are joined in one, seconds between fsyncs and
+#		when to start a new file (0 means never)
+#	function: thread that takes the data of the sinks through a
+#		bounded queue and writes it to timestamped files in big
+#		batches, so a slow SD card never stalls the loop. Every
+#		dropped write is counted. close() writes everything
+#		that is still queued.
+#############################################################
+class LogWriter(threading.Thread):
+	def __init__(self, directory="data", suffix=".csv", queueSize=logQueue, policy=logPolicy, batch=256, fsync=logFsync, rotateBytes=logRotateBytes, rotateSeconds=logRotateSeconds):
+		threading.Thread.__init__(self, name="Log writer")
+		self.daemon = True
+		if policy not in ('drop-oldest', 'drop-newest', 'block'):
+			raise ValueError("Unknown log policy: "+str(policy))
+		self.directory = directory
+		self.suffix = suffix
+		self.queue = Queue.Queue(queueSize)
+		self.policy = policy
+		self.batch = batch
+		self.fsync = fsync
+		self.rotateBytes = rotateBytes
+		self.rotateSeconds = rotateSeconds
+		self.header = ""
+		self.dropped = 0
+		self.written = 0	# bytes written to the current file
+		self.files = []
+		self.file = None
+		self.openFile()
+
+	def openFile(self):
+		if self.file is not None:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			self.file.close()
+		if not os.path.isdir(self.directory):
+			try:
+				os.makedirs(self.directory)
+			except OSError:
+				if not os.path.isdir(self.directory):	# not made by another board process meanwhile
+					raise
+		st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d+%H-%M-%S')
+		path = os.path.join(self.directory, st+self.suffix)
+		n = 1
+		while os.path.exists(path):
+			path = os.path.join(self.directory, st+"-"+str(n)+self.suffix)
+			n += 1
+		self.file = open(path, "wb")
+		self.files.append(path)
+		self.opened = time.time()
+		self.synced = self.opened
+		self.file.write(self.header)
+		self.written = len(self.header)
+
+	# Header repeated at the beginning of every file, call it before start()
+	def setHeader(self, header):
+		self.header = header
+		self.file.write(header)
+		self.written += len(header)
+
+	# Called by the sinks, never blocks unless the policy is 'block'
+	def write(self, data):
+		if self.policy == 'block':
+			self.queue.put(data)
+			return
+		try:
+			self.queue.put_nowait(data)
+		except Queue.Full:
+			self.dropped += 1
+			if self.policy == 'drop-oldest':
+				try:
+					self.queue.get_nowait()
+				except Queue.Empty:
+					pass
+				try:
+					self.queue.put_nowait(data)
+				except Queue.Full:
+					self.dropped += 1
+
+	def run(self):
+		queue = self.queue
+		while True:
+			try:
+				data = queue.get(timeout=self.fsync or 1.0)
+			except Queue.Empty:
+				data = ""
+			if data is StopIteration:
+				break
+			chunks = [data]
+			stop = False
+			while len(chunks) < self.batch:
+				try:
+					data = queue.get_nowait()
+				except Queue.Empty:
+					break
+				if data is StopIteration:
+					stop = True
+					break
+				chunks.append(data)
+			self.writeChunks(chunks)
+			if stop:
+				break
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.file.close()
+
+	def writeChunks(self, chunks):
+		data = ''.join(chunks)
+		if data:
+			self.file.write(data)
+			self.written += len(data)
+		now = time.time()
+		if (self.rotateBytes and self.written >= self.rotateBytes) or (self.rotateSeconds and now - self.opened >= self.rotateSeconds):
+			self.openFile()
+		elif self.fsync and now - self.synced >= self.fsync:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			self.synced = now
+
+	# Writes everything still queued and closes the file
+	def close(self):
+		self.queue.put(StopIteration)
+		self.join()
+		if self.dropped:
+			print "Log writer dropped "+str(self.dropped)+" writes"
+
+
+#############################################################
+# callAll(callbacks)
+#	receives: list of sinks
+#	returns:  one callback that calls all of them in order
+#############################################################
+def callAll(callbacks):
+	def call():
+		for callback in callbacks:
+			callback()
+	return call
+
+
+#############################################################
+# readLogHeader(file)
+#	receives: a binary log opened in binary mode
+#	returns:  the header as a dictionary, the file is left at
+#		the first record
+#############################################################
+def readLogHeader(file):
+	if file.readline() != LOG_MAGIC:
+		raise ValueError("Not a rpi-mw binary log")
+	return json.loads(file.readline())
+
+
+#############################################################
+# binaryToCSV(src, dst)
+#	receives: path of a binary log and of the text file to write
+#	function: writes the same lines that LineSink would have
+#		written, the loop time and the flight time come from
+#		the record timestamps
+#############################################################
+def binaryToCSV(src, dst):
+	fin = open(src, "rb")
+	fout = open(dst, "w")
+	header = readLogHeader(fin)
+	record = struct.Struct(str(header['record']))
+	digits = header['precision']
+	convs = [(channel['scale'], channel['offset']) for channel in header['channels']]
+	start = last = header['start_ns']
+	while True:
+		data = fin.read(record.size*4096)
+		for offset in xrange(0, len(data) - len(data) % record.size, record.size):
+			values = record.unpack_from(data, offset)
+			stamp = values[0]
+			parts = []
+			if header['time']:
+				parts.append(str(round((stamp-last)/1e9, digits)))
+			if header['flyt']:
+				parts.append(str(round((stamp-start)/1e9, digits)))
+			for value, (scale, off) in zip(values[1:], convs):
+				if scale is None:
+					parts.append(str(value))
+				else:
+					parts.append(str(value*scale+off))
+			fout.write(" ".join(parts)+"\n")
+			last = stamp
+		if len(data) < record.size*4096:
+			break
+	fin.close()
+	fout.close()
+
+
+##########################################################################
+################################ Publisher ###############################
+##########################################################################
+# Live telemetry for other programs, over TCP or UDP (unicast/multicast).
+# Every sample is one record: code (B), stamp in ns (q), payload length
+# (B) and the payload as the MW sent it (little endian, see msp_dict).
+# A subscriber chooses what it gets with one text line:
+#	"<MSP names separated by commas, or *> <maximum Hz per message, 0 = all>"
+# TCP clients send it after connecting (all messages by default). UDP
+# clients send it to publishPort and get records there until they send
+# "BYE" or stop renewing it for publishExpiry seconds.
+##########################################################################
+
+PUBLISH_RECORD = struct.Struct('<BqB')
+
+
+#############################################################
+# Subscriber(line)
+#	receives: the subscription line
+#	function: filter by message and decimation to a maximum rate
+#############################################################
+class Subscriber(object):
+	def __init__(self, line="*"):
+		self.codes = None	# every message
+		self.period = 0
+		self.last = {}		# stamp of the last record sent per code
+		self.sent = 0
+		self.decimated = 0
+		self.subscribe(line)
+
+	# Returns False, keeping the previous settings, when the line is not valid
+	def subscribe(self, line):
+		words = line.split()
+		codes = None
+		if words and words[0] != '*':
+			codes = set([CMD2CODE[name] for name in words[0].split(',') if name in CMD2CODE])
+		try:
+			rate = float(words[1]) if len(words) > 1 else 0.0
+		except ValueError:
+			return False
+		if len(words) > 2 or codes == set() or rate != rate:
+			return False
+		self.codes = codes
+		self.period = int(1e9/rate) if 0 < rate < float('inf') else 0
+		return True
+
+	# Records of the batch this subscriber gets, joined
+	def select(self, records):
+		chosen = []
+		for code, stamp, record in records:
+			if self.codes is not None and code not in self.codes:
+				continue
+			if self.period:
+				if stamp - self.last.get(code, 0) < self.period:
+					self.decimated += 1
+					continue
+				self.last[code] = stamp
+			chosen.append(record)
+		self.sent += len(chosen)
+		return ''.join(chosen)
+
+
+#############################################################
+# TCPSubscriber(sock)
+#	receives: connected socket
+#	function: non blocking sender with a bounded backlog. When
+#		the client is too slow and the backlog would grow past
+#		publishBuffer bytes, send() returns False to drop it.
+#############################################################
+class TCPSubscriber(Subscriber):
+	def __init__(self, sock):
+		Subscriber.__init__(self)
+		self.sock = sock
+		self.sock.setblocking(0)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.backlog = ''
+		self.line = ''
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def send(self, data):
+		data = self.backlog+data
+		try:
+			n = self.sock.send(data) if data else 0
+		except socket.error, error:
+			if error.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return False
+			n = 0
+		self.backlog = data[n:]
+		return len(self.backlog) <= publishBuffer
+
+
+#############################################################
+# Publisher(store, loop, port, groups)
+#	receives: TelemetryStore, EventLoop, port for TCP and UDP
+#		subscribers and fixed UDP destinations (multicast or
+#		unicast) as (ip, port, subscription line)
+#	function: sink that serialises every new sample once per sweep
+#		and sends each subscriber the records it asked for. Sends
+#		never block: UDP datagrams that do not fit are lost and
+#		TCP subscribers that fall behind are dropped.
+#############################################################
+class Publisher(object):
+	def __init__(self, store, loop, port=publishPort, groups=publishGroups):
+		self.store = store
+		self.loop = loop
+		self.seq = 0
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(('', port))
+		self.listener.listen(8)
+		self.listener.setblocking(0)
+		self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.udp.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+		self.udp.bind(('', port))
+		self.udp.setblocking(0)
+		self.tcp = []
+		self.datagrams = {}	# address -> (Subscriber, expiry); None for the fixed ones
+		for ip, destination, line in groups:
+			subscriber = Subscriber()
+			if not subscriber.subscribe(line):
+				raise ValueError("bad subscription line for %s:%d: %r" % (ip, destination, line))
+			self.datagrams[(ip, destination)] = (subscriber, None)
+		self.dropped = 0	# TCP subscribers dropped for being slow
+		self.lost = 0		# UDP datagrams that could not be sent
+		self.rejected = 0	# subscription lines that could not be parsed
+		loop.addReader(self.listener, self.onAccept)
+		loop.addReader(self.udp, self.onDatagram)
+
+	def onAccept(self):
+		try:
+			sock, address = self.listener.accept()
+		except socket.error:
+			return
+		subscriber = TCPSubscriber(sock)
+		self.tcp.append(subscriber)
+		self.loop.addReader(subscriber, lambda: self.onLine(subscriber))
+
+	# Subscription lines (or the end) of a TCP subscriber
+	def onLine(self, subscriber):
+		try:
+			data = subscriber.sock.recv(1024)
+		except socket.error:
+			data = ''
+		if not data:
+			self.remove(subscriber)
+			return
+		subscriber.line += data
+		while '\n' in subscriber.line:
+			line, subscriber.line = subscriber.line.split('\n', 1)
+			if not subscriber.subscribe(line):
+				self.rejected += 1
+
+	def onDatagram(self):
+		while True:
+			try:
+				data, address = self.udp.recvfrom(1024)
+			except socket.error:
+				return
+			if data.strip() == "BYE":
+				self.datagrams.pop(address, None)
+				continue
+			subscriber = Subscriber()
+			if subscriber.subscribe(data):
+				self.datagrams[address] = (subscriber, monotonicNs()+int(publishExpiry*1e9))
+			else:
+				self.rejected += 1	# an existing subscription keeps its settings
+
+	def remove(self, subscriber):
+		self.loop.removeReader(subscriber)
+		subscriber.sock.close()
+		self.tcp.remove(subscriber)
+
+	def __call__(self):
+		seq = self.seq
+		records = []
+		for code, entry in self.store.snapshot().items():
+			if entry.seq > seq:
+				payload = MSP_CODECS[code].pack(entry.raw)
+				records.append((code, entry.stamp, PUBLISH_RECORD.pack(code, entry.stamp, len(payload))+payload))
+				self.seq = max(self.seq, entry.seq)
+		if not records:
+			return
+		for subscriber in self.tcp[:]:
+			if not subscriber.send(subscriber.select(records)):
+				self.dropped += 1
+				self.remove(subscriber)
+		now = monotonicNs()
+		for address, (subscriber, expiry) in self.datagrams.items():
+			if expiry is not None and now > expiry:
+				del self.datagrams[address]
+				continue
+			data = subscriber.select(records)
+			if not data:
+				continue
+			try:
+				self.udp.sendto(data, address)
+			except socket.error:
+				self.lost += 1
+
+	def close(self):
+		for subscriber in self.tcp[:]:
+			self.remove(subscriber)
+		self.loop.removeReader(self.listener)
+		self.loop.removeReader(self.udp)
+		self.listener.close()
+		self.udp.close()
+
+
+#############################################################
+# readRecords(data)
+#	receives: bytes received from the Publisher
+#	returns:  list of (code, stamp, record) of the complete
+#		records and the bytes left over (the start of the next
+#		record on TCP)
+#############################################################
+def readRecords(data):
+	records = []
+	i = 0
+	while i+PUBLISH_RECORD.size <= len(data):
+		code, stamp, size = PUBLISH_RECORD.unpack_from(data, i)
+		end = i+PUBLISH_RECORD.size+size
+		if end > len(data):
+			break
+		records.append((code, stamp, MSP_CODECS[code].decode(data[i+PUBLISH_RECORD.size:end])))
+		i = end
+	return records, data[i:]
+
+
+##########################################################################
+################################# Replay #################################
+##########################################################################
+# Decoding of raw captures of what the MW sent, offline
+##########################################################################
+
+#############################################################
+# replayStream(data, onRecord, chunk)
+#	receives: raw bytes sent by the MW, function called with
+#		(code, record) for every frame (None to only decode) and
+#		how many bytes are fed to the parser at a time
+#	function: feeds the bytes through the same MSPParser and
+#		codecs as the live loop, as fast as possible
+#	returns:  dictionary with the frames per MSP name, checksum
+#		errors, bytes, seconds, frames/s and MB/s
+#############################################################
+def replayStream(data, onRecord=None, chunk=65536):
+	parser = MSPParser(size=2*chunk)
+	codecs = MSP_CODECS
+	counts = collections.defaultdict(int)
+	start = timeit.default_timer()
+	for i in xrange(0, len(data), chunk):
+		parser.feed(buffer(data, i, chunk))
+		for code, payload in parser:
+			counts[code] += 1
+			codec = codecs.get(code)
+			if codec is None:
+				continue
+			record = codec.decode(payload)
+			if onRecord is not None and record is not None:
+				onRecord(code, record)
+	seconds = max(timeit.default_timer()-start, 1e-9)
+	return {
+		'frames': dict([(CODE2CMD.get(code, str(code)), n) for code, n in counts.items()]),
+		'errors': parser.errors,
+		'bytes': len(data),
+		'seconds': seconds,
+		'frames_per_s': parser.frames/seconds,
+		'mb_per_s': len(data)/seconds/1e6}
+
+
+# numpy type of every struct type
+NUMPY_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8', 'f': 'f4', 'd': 'f8'}
+
+
+#############################################################
+# bulkDecode(data)
+#	receives: raw bytes sent by the MW
+#	function: vectorised decoding with numpy. Finds every
+#		header, checks all the checksums of the frames of one
+#		size at once, then views the payloads of each fixed
+#		layout message as a structured array.
+#	returns:  dictionary of MSP name -> OrderedDict of columns
+#		(position of every frame in the data, then the fields,
+#		scaled like the records)
+#############################################################
+def bulkDecode(data):
+	if numpy is None:
+		raise ImportError("bulkDecode needs numpy")
+	raw = numpy.frombuffer(data, dtype=numpy.uint8)
+	starts = numpy.flatnonzero((raw[:-5] == 36) & (raw[1:-4] == 77) & (raw[2:-3] == 62))
+	sizes = raw[starts+3].astype(numpy.int64)
+	complete = starts+6+sizes <= len(raw)
+	starts, sizes = starts[complete], sizes[complete]
+	good = numpy.zeros(len(starts), dtype=bool)
+	for size in numpy.unique(sizes):
+		index = numpy.flatnonzero(sizes == size)
+		block = raw[starts[index, None]+3+numpy.arange(size+2)]	# size, code and payload
+		good[index] = numpy.bitwise_xor.reduce(block, axis=1) == raw[starts[index]+5+size]
+	starts, sizes = starts[good], sizes[good]
+	# headers inside the payload of a good frame are not frames
+	accepted = []
+	end = 0
+	for start, size in zip(starts.tolist(), sizes.tolist()):
+		if start >= end:
+			accepted.append(start)
+			end = start+6+size
+	starts = numpy.array(accepted, dtype=numpy.int64)
+	codes = raw[starts+4]
+	sizes = raw[starts+3]
+	result = {}
+	for code in numpy.unique(codes).tolist():
+		codec = MSP_CODECS.get(code)
+		if codec is None or codec.kind != 'fixed' or not codec.responseFormat:
+			continue
+		index = numpy.flatnonzero((codes == code) & (sizes == codec.size))
+		if not len(index):
+			continue
+		dtype = numpy.dtype([(field, '<'+NUMPY_TYPES[char]) for field, char in zip(codec.fields, structTypes(codec.struct.format))])
+		table = raw[starts[index, None]+5+numpy.arange(codec.size)].view(dtype).ravel()
+		columns = collections.OrderedDict([('position', starts[index])])
+		for i, field in enumerate(codec.fields):
+			if codec.scaled:
+				columns[field] = table[field]*codec.scales[i]+codec.offsets[i]
+			else:
+				columns[field] = table[field]
+		result[codec.name] = columns
+	return result
+
+
+#############################################################
+# replayFile(path, bulk)
+#	receives: raw capture (or session capture) and if the numpy
+#		path is used
+#	outputs:  throughput, and with bulk the columns saved to
+#		<path>.npz as "MSP name.field"
+#############################################################
+def replayFile(path, bulk=False):
+	f = open(path, "rb")
+	data = f.read()
+	f.close()
+	if data.startswith(CAPTURE_MAGIC):
+		data = ''.join([chunk for stamp, source, chunk in readCapture(path) if source == SERIAL_RX])
+	stats = replayStream(data)
+	print "parser: %d frames (%d bad) in %.3f s, %.0f frames/s, %.1f MB/s" % (sum(stats['frames'].values()), stats['errors'], stats['seconds'], stats['frames_per_s'], stats['mb_per_s'])
+	for name, n in sorted(stats['frames'].items()):
+		print "  %-20s %d" % (name, n)
+	if bulk:
+		start = timeit.default_timer()
+		result = bulkDecode(data)
+		seconds = max(timeit.default_timer()-start, 1e-9)
+		frames = sum([len(columns['position']) for columns in result.values()])
+		print "bulk: %d frames in %.3f s, %.0f frames/s, %.1f MB/s" % (frames, seconds, frames/seconds, len(data)/seconds/1e6)
+		arrays = {}
+		for name, columns in result.items():
+			for field, column in columns.items():
+				arrays[name+"."+field] = column
+		numpy.savez(path+".npz", **arrays)
+
+
+##########################################################################
+################################ Sessions ################################
+##########################################################################
+# Capture of everything read from and written to the MW and every UDP
+# datagram, to play the session again later. The file is the magic line
+# followed by chunks: stamp in ns (q), source (B), length (H) and data.
+##########################################################################
+
+CAPTURE_MAGIC = "RPIMW-CAP 1\n"
+CAPTURE_CHUNK = struct.Struct('<qBH')
+SERIAL_RX = 0		# bytes read from the MW
+SERIAL_TX = 1		# bytes written to the MW
+UDP_RX = 2			# UDP datagrams received
+
+
+#############################################################
+# SessionRecorder(directory, size, period)
+#	receives: where the capture goes, the bytes of each of its
+#		two buffers and the seconds between writes
+#	function: add() stamps and copies every chunk into the active
+#		preallocated buffer. The thread swaps the buffers when
+#		one is full (or every period) and writes the full one,
+#		so the loop never waits for the file. Chunks that find
+#		both buffers full are dropped and counted.
+#############################################################
+class SessionRecorder(threading.Thread):
+	def __init__(self, directory="data", size=recordBuffer, period=logFsync):
+		threading.Thread.__init__(self, name="Session recorder")
+		self.daemon = True
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d+%H-%M-%S')
+		self.path = os.path.join(directory, st+".cap")
+		self.file = open(self.path, "wb")
+		self.file.write(CAPTURE_MAGIC)
+		self.buffers = [bytearray(size), bytearray(size)]
+		self.active = 0		# buffer being filled
+		self.used = 0		# bytes used of it
+		self.full = None	# (buffer, bytes) waiting to be written
+		self.cond = threading.Condition()
+		self.period = period
+		self.running = True
+		self.chunks = 0
+		self.dropped = 0
+
+	# Stamps and buffers one chunk of source
+	def add(self, source, data):
+		n = len(data)
+		if n > 0xFFFF:
+			for i in xrange(0, n, 0xFFFF):
+				self.add(source, buffer(data, i, 0xFFFF))
+			return
+		stamp = monotonicNs()
+		size = CAPTURE_CHUNK.size+n
+		with self.cond:
+			buf = self.buffers[self.active]
+			if self.used+size > len(buf):
+				if self.full is not None or size > len(buf):
+					self.dropped += 1
+					return
+				self.swap()
+				buf = self.buffers[self.active]
+			i = self.used
+			CAPTURE_CHUNK.pack_into(buf, i, stamp, source, n)
+			buf[i+CAPTURE_CHUNK.size:i+size] = data
+			self.used = i+size
+			self.chunks += 1
+
+	# Hands the active buffer to the thread, call with cond held
+	def swap(self):
+		self.full = (self.buffers[self.active], self.used)
+		self.active = 1-self.active
+		self.used = 0
+		self.cond.notify()
+
+	def run(self):
+		while True:
+			with self.cond:
+				if self.full is None and self.running:
+					self.cond.wait(self.period)
+				if self.full is None and self.used:
+					self.swap()
+				full = self.full
+				running = self.running
+			if full is not None:
+				self.file.write(buffer(full[0], 0, full[1]))
+				self.file.flush()
+				with self.cond:
+					self.full = None
+			elif not running:
+				break
+		self.file.close()
+
+	def close(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify()
+		self.join()
+
+
+#############################################################
+# RecordingPort(port, recorder)
+#	receives: serial port and SessionRecorder
+#	function: serial port that adds every read and write to the
+#		capture
+#############################################################
+class RecordingPort(object):
+	def __init__(self, port, recorder):
+		self.port = port
+		self.recorder = recorder
+
+	def write(self, data):
+		self.recorder.add(SERIAL_TX, data)
+		return self.port.write(data)
+
+	def read(self, size=1):
+		data = self.port.read(size)
+		if data:
+			self.recorder.add(SERIAL_RX, data)
+		return data
+
+	def __getattr__(self, name):
+		return getattr(self.port, name)
+
+
+#############################################################
+# readCapture(path)
+#	receives: capture made by a SessionRecorder
+#	returns:  generator of (stamp, source, data) of every chunk
+#############################################################
+def readCapture(path):
+	f = open(path, "rb")
+	if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+		f.close()
+		raise ValueError(path+" is not a session capture")
+	while True:
+		header = f.read(CAPTURE_CHUNK.size)
+		if len(header) < CAPTURE_CHUNK.size:
+			break
+		stamp, source, n = CAPTURE_CHUNK.unpack(header)
+		data = f.read(n)
+		if len(data) < n:
+			break	# cut by the end of the session
+		yield stamp, source, data
+	f.close()
+
+
+#############################################################
+# SessionPlayer(path, speed, udp)
+#	receives: capture, how fast it is played (1 = as recorded)
+#		and where the UDP datagrams are sent
+#	function: plays a capture again with its timing. It works as
+#		the serial port of the loop: the bytes the MW sent come
+#		out of read() (through a pipe, so select works) at their
+#		recorded times, writes are only counted, and the UDP
+#		datagrams are sent to udp at their times. At the end of
+#		the session read() returns nothing and onEnd, if set, is
+#		called once.
+#############################################################
+class SessionPlayer(threading.Thread):
+	def __init__(self, path, speed=1.0, udp=('127.0.0.1', udp_port)):
+		threading.Thread.__init__(self, name="Session player")
+		self.daemon = True
+		self.path = path
+		self.speed = speed
+		self.udp = udp
+		self.port = path
+		self.baudrate = ser.baudrate
+		self.rx, self.tx = os.pipe()
+		fcntl.fcntl(self.rx, fcntl.F_SETFL, fcntl.fcntl(self.rx, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.opened = False
+		self.ended = False
+		self.onEnd = None
+		self.written = 0	# bytes written by the loop
+		self.recorded = 0	# bytes written in the recorded session
+
+	def run(self):
+		start = monotonicNs()
+		first = None
+		for stamp, source, data in readCapture(self.path):
+			if first is None:
+				first = stamp
+			wait = (stamp-first)/self.speed/1e9 - (monotonicNs()-start)/1e9
+			if wait > 0:
+				time.sleep(wait)
+			if source == SERIAL_RX:
+				os.write(self.tx, data)
+			elif source == UDP_RX:
+				self.sock.sendto(data, self.udp)
+			else:
+				self.recorded += len(data)
+		os.close(self.tx)	# the end of the session reads as a closed port
+
+	# serial port interface for the loop
+	def open(self):
+		self.opened = True
+		self.start()
+
+	def isOpen(self):
+		return self.opened
+
+	def close(self):
+		self.opened = False
+
+	def fileno(self):
+		return self.rx
+
+	def inWaiting(self):
+		return struct.unpack('i', fcntl.ioctl(self.rx, termios.FIONREAD, '\0\0\0\0'))[0]
+
+	def read(self, size=1):
+		try:
+			data = os.read(self.rx, size)
+		except OSError, error:
+			if error.errno == errno.EAGAIN:
+				return ''
+			raise
+		if not data and not self.ended:
+			self.ended = True
+			if self.onEnd is not None:
+				self.onEnd()
+		return data
+
+	def write(self, data):
+		self.written += len(data)
+		return len(data)
+
+
+##########################################################################
+############################### Parameters ###############################
+##########################################################################
+# Tuning of the MW (PIDs, rates, misc and boxes) through the running link
+##########################################################################
+
+# Tuning blocks and the command that writes each of them
+TUNING = [('MSP_PID', 'MSP_SET_PID'), ('MSP_RC_TUNING', 'MSP_SET_RC_TUNING'), ('MSP_MISC', 'MSP_SET_MISC'), ('MSP_BOX', 'MSP_SET_BOX')]
+
+
+#############################################################
+# ParameterStore(link, loop, timeout, retries, port)
+#	receives: SerialLink, EventLoop, seconds to wait for an answer,
+#		how many times a block is asked and the port to write to
+#		(a bulk ClassPort, the port of the link by default)
+#	function: local copy of the tuning blocks. load() asks all of
+#		them in one write, get() reads the copy (never the link)
+#		and set() changes it and marks the block dirty. flush()
+#		writes only the dirty blocks that differ from the board,
+#		all in one write followed by their read-back, and a
+#		block is clean again once the board answers with what
+#		was written. Everything goes through the link without
+#		waiting: the answers are taken from the TelemetryStore
+#		by a timer of the loop, so telemetry keeps flowing.
+#		state[name] is 'empty', 'loading', 'clean', 'dirty',
+#		'writing' or 'failed'.
+#############################################################
+class ParameterStore(object):
+	def __init__(self, link, loop, timeout=0.5, retries=3, port=None):
+		self.link = link
+		self.port = port or link.port
+		self.timeout = int(timeout*1e9)
+		self.retries = retries
+		self.setters = dict(TUNING)
+		self.blocks = {}	# name -> record, with the local changes
+		self.board = {}		# name -> raw values the board has
+		self.state = dict([(name, 'empty') for name, setter in TUNING])
+		self.asked = {}		# name -> (store seq when asked, monotonicNs, tries)
+		self.expected = {}	# name -> raw values written, waiting for the read-back
+		self.verified = 0
+		self.timer = loop.addTimer(0.02, self.service)
+
+	def load(self, names=None):
+		names = names or [name for name, setter in TUNING]
+		for name in names:
+			if self.state[name] != 'dirty':
+				self.state[name] = 'loading'
+		self.ask(names)
+
+	def ask(self, names):
+		self.port.write(''.join([MSP_REQUESTS[name] for name in names]))
+		seq = self.link.store.seq
+		now = monotonicNs()
+		for name in names:
+			tries = self.asked.get(name, (0, 0, 0))[2]
+			self.asked[name] = (seq, now, tries+1)
+
+	# Cached record of a block, or one field (or item of a field) of it
+	def get(self, name, field=None, index=None):
+		record = self.blocks.get(name)
+		if record is None or field is None:
+			return record
+		value = getattr(record, field)
+		if index is not None:
+			return value[index]
+		return value
+
+	# Raises ValueError, keeping the block as it was, when the value does not fit the field
+	def set(self, name, field, value, index=None):
+		record = self.blocks.get(name)
+		if record is None:
+			raise ValueError(name+" is not loaded")
+		if index is not None:
+			column = list(getattr(record, field))
+			column[index] = value
+			value = tuple(column)
+		record = record._replace(**{field: value})
+		try:
+			MSP_CODECS_BY_NAME[self.setters[name]].encode(record)
+		except (struct.error, TypeError, ValueError), error:
+			raise ValueError("%s.%s can not be %r: %s" % (name, field, value, error))
+		self.blocks[name] = record
+		self.state[name] = 'dirty'
+
+	# Writes the dirty blocks, returns the names written
+	def flush(self):
+		frames = []
+		names = []
+		for name, state in self.state.items():
+			if state != 'dirty':
+				continue
+			record = self.blocks[name]
+			try:
+				expected = tuple(MSP_CODECS_BY_NAME[name].raw(record))
+				frame = MSP_CODECS_BY_NAME[self.setters[name]].encode(record)
+			except (struct.error, TypeError, ValueError), error:
+				self.state[name] = 'failed'	# never stops the loop
+				print name+": can not be written: "+str(error)
+				continue
+			if expected == self.board.get(name):
+				self.state[name] = 'clean'
+				continue
+			frames.append(frame)
+			self.expected[name] = expected
+			self.state[name] = 'writing'
+			names.append(name)
+		if names:
+			self.port.write(''.join(frames))
+			for name in names:
+				self.asked.pop(name, None)
+			self.ask(names)	# read-back
+		return names
+
+	# Saves the tuning of the MW to its EEPROM
+	def save(self):
+		self.port.write(MSP_REQUESTS['MSP_EEPROM_WRITE'])
+
+	# True while blocks are being loaded or written
+	def busy(self):
+		return bool(self.asked)
+
+	# Called by the timer, takes the answers from the store
+	def service(self):
+		now = monotonicNs()
+		store = self.link.store
+		for name, (seq, stamp, tries) in self.asked.items():
+			entry = store.get(CMD2CODE[name])
+			if entry is not None and entry.seq > seq:
+				del self.asked[name]
+				self.answered(name, entry)
+			elif now-stamp > self.timeout:
+				if tries < self.retries:
+					self.ask([name])
+				else:
+					del self.asked[name]
+					self.expected.pop(name, None)
+					self.state[name] = 'failed'
+					print name+": no answer from the MW"
+
+	def answered(self, name, entry):
+		raw = tuple(entry.raw)
+		self.board[name] = raw
+		expected = self.expected.pop(name, None)
+		if expected is not None:
+			if expected == raw:
+				self.blocks[name] = entry.record
+				self.state[name] = 'clean'
+				self.verified += 1
+			else:
+				self.state[name] = 'failed'	# the local copy keeps the wanted values
+				print name+": the MW did not take the new values"
+		elif self.state[name] != 'dirty':
+			self.blocks[name] = entry.record
+			self.state[name] = 'clean'
+
+
+#############################################################
+# applyChange(params, change)
+#	receives: ParameterStore and a change like "MSP_PID.p[0]=40"
+#		or "MSP_RC_TUNING.rcRate=0.9"
+#	function: sets the value in the local copy (flush() writes it)
+#	returns:  False if the change is not valid or not loaded
+#############################################################
+def applyChange(params, change):
+	match = re.match(r'(\w+)\.(\w+)(?:\[(\d+)\])?=(.+)$', change)
+	if match is None or match.group(1) not in params.blocks:
+		return False
+	name, field, index, value = match.groups()
+	try:
+		params.set(name, field, float(value), None if index is None else int(index))
+	except (ValueError, TypeError, IndexError, AttributeError):
+		return False
+	return True
+
+
+#############################################################
+# tune(changes, save)
+#	receives: list of changes like "MSP_PID.p[0]=40" or
+#		"MSP_RC_TUNING.rcRate=0.9" and if they are saved to
+#		the EEPROM
+#	function: connects to the MW, loads and prints the tuning,
+#		then writes the changes and checks them
+#############################################################
+def tune(changes, save=False):
+	ser.open()
+	if waitReady(ser) is None:
+		print("MultiWii not ready after "+str(wakeUp)+" seconds")
+		return
+	loop = EventLoop()
+	link = SerialLink(ser, TelemetryStore(), [], False)
+	loop.addReader(ser, link.onReadable)
+	params = ParameterStore(link, loop)
+	def done(then):
+		def check():
+			if not params.busy():
+				loop.callLater(0, then)
+			else:
+				loop.callLater(0.02, check)
+		return check
+	def write():
+		for change in changes:
+			if not applyChange(params, change):
+				print "Unknown change: "+change
+		params.flush()
+		loop.callLater(0, done(finish))
+	def finish():
+		for name, setter in TUNING:
+			print "%s (%s): %s" % (name, params.state[name], params.get(name))
+		if save and params.verified:
+			params.save()
+		loop.stop()
+	params.load()
+	loop.callLater(0, done(write))
+	try:
+		loop.run()
+	finally:
+		ser.close()
+
+
+##########################################################################
+################################# Boards #################################
+##########################################################################
+# Several MultiWii at once, one process per serial port
+##########################################################################
+
+#############################################################
+# serialPort(port, baudrate)
+#	receives: serial port name and baud rate
+#	returns:  a closed serial.Serial with the settings of ser
+#############################################################
+def serialPort(port, baudrate):
+	s = serial.Serial()
+	s.port = port
+	s.baudrate = baudrate
+	for setting in ['bytesize', 'parity', 'stopbits', 'timeout', 'xonxoff', 'rtscts', 'dsrdtr', 'writeTimeout']:
+		setattr(s, setting, getattr(ser, setting))
+	return s
+
+
+#############################################################
+# BoardFeed(board, store, queue)
+#	receives: board id, its TelemetryStore and the queue of the
+#		aggregated stream
+#	function: sink that puts the answers of every sweep in the
+#		queue in one item, (board id, [(code, stamp, raw)]).
+#		When the queue is full the sweep is dropped and counted,
+#		the acquisition never waits for the consumer.
+#############################################################
+class BoardFeed(object):
+	def __init__(self, board, store, queue):
+		self.board = board
+		self.store = store
+		self.queue = queue
+		self.seq = 0		# newest entry already sent
+		self.dropped = 0
+
+	def __call__(self):
+		seq = self.seq
+		batch = []
+		for code, entry in self.store.snapshot().items():
+			if entry.seq > seq:
+				batch.append((code, entry.stamp, entry.raw))
+				self.seq = max(self.seq, entry.seq)
+		if not batch:
+			return
+		try:
+			self.queue.put_nowait((self.board, batch))
+		except Queue.Full:
+			self.dropped += 1
+
+
+#############################################################
+# BoardProcess(board, queue)
+#	receives: (board id, serial port, baud rate, rates) and the
+#		queue of the aggregated stream
+#	function: process that acquires one board on its own: serial
+#		port, event loop, poll schedule (the rates, or drone.RATES
+#		of the enabled messages when None) and log file in
+#		data/<board id>/, feeding every sweep to the queue.
+#		Stamps come from the monotonic clock, shared by all the
+#		processes, so the boards stay on one time base.
+#############################################################
+class BoardProcess(multiprocessing.Process):
+	def __init__(self, board, queue):
+		multiprocessing.Process.__init__(self, name="MultiWii "+board[0])
+		self.daemon = True
+		self.board = board
+		self.queue = queue
+
+	def run(self):
+		signal.signal(signal.SIGINT, signal.SIG_IGN)	# the parent stops the boards
+		drone.PRINT = 0	# the parent prints the aggregated stream
+		ident, name, baudrate, rates = self.board
+		try:
+			scheduler = PollScheduler(rates if rates is not None else enabledRates(), baudrate)
+		except ValueError, e:
+			print(ident+": "+str(e))
+			return
+		port = serialPort(name, baudrate)
+		try:
+			port.open()
+		except Exception, e:
+			print(ident+": error open serial port: "+str(e))
+			return
+		ready = waitReady(port)
+		if ready is None:
+			print(ident+": not ready after "+str(wakeUp)+" seconds, starting anyway")
+		else:
+			print(ident+": ready in %.2f seconds" % ready[0])
+		loop = EventLoop()
+		store = TelemetryStore()
+		link = SerialLink(port, store, scheduler.names, scheduler=scheduler)
+		file = None
+		sinks = []
+		if drone.FILE:
+			file = LogWriter(directory=os.path.join("data", ident), suffix=".bin" if drone.BIN else ".csv")
+			if drone.BIN:
+				sinks.append(BinarySink(store, file))
+			else:
+				sinks.append(LineSink(store, None, file))
+			file.start()
+		feed = BoardFeed(ident, store, self.queue)
+		sinks.append(feed)
+		link.onSweep = callAll(sinks)
+		def poll():
+			loop.callLater(link.tick(), poll)
+		loop.addReader(port, link.onReadable)
+		loop.callLater(0, poll)
+		signal.signal(signal.SIGTERM, lambda *args: loop.stop())
+		try:
+			loop.run()
+		except Exception, e:
+			print(ident+": error on the board: "+str(e))
+		finally:
+			port.close()
+			if file is not None:
+				file.close()
+			if feed.dropped:
+				print(ident+": "+str(feed.dropped)+" sweeps dropped by the aggregated stream")
+
+
+#############################################################
+# acquireBoards(boards, onSample, duration)
+#	receives: list of (board id, serial port, baud rate, rates),
+#		function called with (board id, code, stamp, record)
+#		for every sample of the aggregated stream (None prints
+#		it when drone.PRINT) and seconds to run (None = until
+#		Ctrl-C)
+#	function: starts one BoardProcess per board and decodes the
+#		aggregated stream of all of them
+#	returns:  samples received per board
+#############################################################
+def acquireBoards(boards, onSample=None, duration=None):
+	queue = multiprocessing.Queue(logQueue)
+	processes = [BoardProcess(board, queue) for board in boards]
+	for process in processes:
+		process.start()
+	samples = dict([(board[0], 0) for board in boards])
+	start = timeit.default_timer()
+	try:
+		while any([process.is_alive() for process in processes]):
+			if duration is not None and timeit.default_timer()-start > duration:
+				break
+			try:
+				ident, batch = queue.get(timeout=0.5)
+			except Queue.Empty:
+				continue
+			samples[ident] += len(batch)
+			for code, stamp, raw in batch:
+				record = MSP_CODECS[code].make(raw)
+				if onSample is not None:
+					onSample(ident, code, stamp, record)
+				elif drone.PRINT:
+					print ident+" "+CODE2CMD[code]+" "+" ".join(map(str, record))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for process in processes:
+			if process.is_alive():
+				process.terminate()
+		for process in processes:
+			process.join()
+	elapsed = timeit.default_timer()-start
+	for ident in sorted(samples):
+		print "%s: %d samples (%.1f per second)" % (ident, samples[ident], samples[ident]/elapsed)
+	return samples
 
 
 ####################################################################
 ####################### MAIN #######################################
 ####################################################################
-# main()
-#	receives: -
+# main(setup)
+#	receives: function called with the EventLoop and the
+#		ParameterStore before the loop runs (or None), to
+#		schedule work on them like tuning changes in flight
 #	outputs:  -
 #	function: opens serial port
-#		 loops msp commands
+#		 runs the event loop with the serial link, the UDP
+#		 endpoint, the parameter store and the sinks, and
+#		 saves the telemetry history at the end
 ####################################################################
-def main():
-	global beginFlag
-	global udp_mess2 #Need to be able to modify the value of this variable
-
-	if drone.ASY:
-		print ("Beginning Asyncore UDP server on ")+str(udp_ip)
-		AsyncoreServerUDP()
-		loop_thread = threading.Thread(target=asyncore.loop, name="Asyncore Loop")
-		loop_thread.start()
-	if drone.SCK:
-		print ("Beginning regular UDP server on ")+str(udp_ip)
-		sock.bind((udp_ip, udp_port))
-	if drone.SCKSRV:
-		print ("Beginning UDP socketserver on ")+str(udp_ip)
-		server = SocketServer.UDPServer((udp_ip, udp_port), SocketServerHandler)
-		loop_thread = threading.Thread(target=server.serve_forever, name="SocketServer Loop")
-		loop_thread.start()
-
-	print ("Beginning Multiwii - wait "+str(wakeUp)+" seconds...")
+def main(setup=None):
+	global params, history, tx_ports
+	history = None
+	loop = EventLoop()
+	store = TelemetryStore()
+	scheduler = None
+	if drone.SCHED:
+		scheduler = PollScheduler(enabledRates(), ser.baudrate)
+		for name, hz in scheduler.plan:
+			print "Polling %s at %.1f Hz" % (name, hz)
+	recorder = None
+	port = ser
+	if drone.REC:
+		recorder = SessionRecorder()
+		recorder.start()
+		port = RecordingPort(ser, recorder)
+		print "Recording the session to "+recorder.path
+	txq = TransmitQueue(port, loop, ser.baudrate)
+	ports = classPorts(txq)
+	link = SerialLink(ports[TX_TELEMETRY], store, enabledMessages(), drone.PIPE, scheduler=scheduler)
+	udp = None
+	file = None
+	bridge = None
+
+	if drone.UDP:
+		print ("Beginning UDP endpoint on ")+str(udp_ip)
+		udp = UDPEndpoint(udp_ip, udp_port, udpFields)
+		loop.addReader(udp, udp.onReadable)
+		if recorder is not None:
+			udp.onDatagram = lambda data: recorder.add(UDP_RX, data)
+
+	print ("Beginning Multiwii - waiting up to "+str(wakeUp)+" seconds for it to be ready...")
 
 	try:
 		ser.open()		# Opens the MultiWii serial port
@@ -843,86 +3393,109 @@ def main():
 		exit()
 	
 	if ser.isOpen():
-		time.sleep(wakeUp)		# Gives time for the MultiWii to calibrate and begin sending live info
+		ready = waitReady(port)		# Gives time for the MultiWii to calibrate and begin sending live info
+		if ready is None:
+			print("MultiWii not ready after "+str(wakeUp)+" seconds, starting anyway")
+		else:
+			print("MultiWii ready in %.2f seconds (version %d, multitype %d)" % (ready[0], ready[1].version, ready[1].multitype))
+			metadata, cached = boardMetadata(port, ready[1])
+			if 'MSP_BOXNAMES' in metadata:
+				print("Boxes"+(" (cached)" if cached else "")+": "+", ".join(metadata['MSP_BOXNAMES'].names))
 
 		if drone.FILE:
-			st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d+%H-%M-%S')+".csv"
-			file = open("data/"+st, "w")
-		if drone.FLYT:
-			flytime = timeit.default_timer()
-		
+			file = LogWriter(suffix=".bin" if drone.BIN else ".csv")
+
+		def poll():
+			loop.callLater(link.tick(), poll)
+
+		source = store	# what the sinks read the telemetry from
+		mocap = udp
+		merge = None
+		if udp is not None and mocapMerge:
+			merge = source = mocap = MocapMerge(store, udp)
+
+		sinks = []
+		if drone.BIN and file is not None:
+			if merge is not None and merge.fields is None:
+				print "Set udpFields to log the mocap in the binary log"
+			sinks.append(BinarySink(source, file, merge if merge is not None and merge.fields else None))
+			if drone.PRINT:
+				sinks.append(LineSink(source, mocap))
+		else:
+			sinks.append(LineSink(source, mocap, file))
+		if drone.HIST:
+			history = TelemetryHistory(source)
+			sinks.append(history)
+		live = []	# sinks of the raw store, called right after every sweep and never behind the merge
+		if drone.PUB:
+			live.append(Publisher(store, loop))
+		if drone.PROF:
+			profiler = startProfiler()
+			sinks = instrument(profiler, link, sinks, file)
+			live = [profiler.timed('sink '+sink.__class__.__name__, sink) for sink in live]
+		if merge is not None:
+			merge.onMerged = callAll(sinks)
+			link.onSweep = callAll(live+[merge])
+		else:
+			link.onSweep = callAll(sinks+live)
+		if file is not None:
+			file.start()
+		loop.addReader(link.port, link.onReadable)
+		loop.callLater(0, poll)
+		if isinstance(ser, SessionPlayer):
+			ser.onEnd = loop.stop	# played to the end
+		if drone.CMD and drone.UDP:
+			bridge = ControlBridge(udp, ports[TX_CONTROL])
+			loop.addTimer(1.0/rcRate, bridge)
+		params = ParameterStore(link, loop, port=ports[TX_BULK])	# tuning read and written next to the telemetry
+		tx_ports = ports	# sendCommand(), sendData() and setRC() go through the queue too
+		loop.callLater(0, params.load)
+		if setup is not None:
+			setup(loop, params)
+
 		try:
-			while True:
-		#########################################################################
-		# Loop
-		#########################################################################
-				#Start timing
-				timestamp = timeit.default_timer()
-
-				if drone.CMD and drone.UDP:
-					setRC()
-				if drone.ATT:
-					askATT()
-				if drone.ALT:
-					askALT()
-				if drone.RC:
-					askRC()
-				if drone.MOT:
-					askMOTOR()
-				if drone.RAW:
-					askRAW()
-				if drone.SCK:
-					getUDP()
-
-				#Finish timing and save the time difference
-				diff = timeit.default_timer() - timestamp
-				elapsed = timeit.default_timer() - flytime
-
-				if beginFlag != 1:	# Won't send any data until both altitude and heading are valid data
-					#Start adding all data to a variable
-					if drone.TIME:
-						message = str(round(diff,precision))
-					#Save elapsed time
-					if drone.FLYT:
-						message = message+" "+str(round(elapsed,precision))
-					#save attitude
-					if drone.ATT:
-						message = message+" "+str(angx)+" "+str(angy)+" "+str(heading)
-					#save pilot commands
-					if drone.RC:
-						message = message+" "+str(roll)+" "+str(pitch)+" "+str(yaw)+" "+str(throttle)
-					#save altitude
-					if drone.ALT:
-						message = message+" "+str(altitude)
-					#save motors
-					if drone.MOT:
-						message = message+" "+str(m1)+" "+str(m2)+" "+str(m3)+" "+str(m4)
-					#save raw
-					if drone.RAW:
-						message = message+" "+str(ax)+" "+str(ay)+" "+str(az)+" "+str(gx)+" "+str(gy)+" "+str(gz)+" "+str(magx)+" "+str(magy)+" "+str(magz)
-					#save udp
-					if drone.UDP:
-						if udp_mess == "":
-							message = message+" "+udp_mess2
-							udp_mess2=""
-						message = message+" "+udp_mess
-					#print to terminal
-					if drone.PRINT:
-						print(message)	
-					# print in CSV file
-					if drone.FILE:
-						file.write(message+"\n")
-
-				else:			# If invalid, continue looping
-					beginFlag = 0	# resets the flag
-			ser.close()
-			file.close()
-		
+			loop.run()
+		except KeyboardInterrupt:
+			pass
 		except Exception,e1:	# Catches any errors in the serial communication
 			print("Error on main: "+str(e1))
+		finally:
+			tx_ports = None
+			ser.close()
+			if file is not None:
+				file.close()	# writes everything still queued
+			if bridge is not None:
+				print bridge.report()
+			print txq.report()
+			if udp is not None:
+				print udp.report()
+			if history is not None and history.count:
+				if not os.path.exists("data"):
+					os.makedirs("data")
+				path = os.path.join("data", datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d+%H-%M-%S')+".npy")
+				history.save(path)
+				print "History of the last %d samples saved to %s" % (history.count, path)
+			if recorder is not None:
+				recorder.close()
+				print "Session recorded to %s (%d chunks, %d dropped)" % (recorder.path, recorder.chunks, recorder.dropped)
 	else:
 		print("Cannot open serial port")
 
 #-----------------------------------------------------------------------
 if __name__=="__main__":
-	main()
\ No newline at end of file
+	if len(sys.argv) > 2 and sys.argv[1] == "tocsv":
+		binaryToCSV(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else sys.argv[2].rsplit('.', 1)[0]+".csv")
+	elif len(sys.argv) > 2 and sys.argv[1] == "replay":
+		replayFile(sys.argv[2], len(sys.argv) > 3 and sys.argv[3] == "bulk")
+	elif len(sys.argv) > 2 and sys.argv[1] == "play":
+		ser = SessionPlayer(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
+		udp_ip = "127.0.0.1"	# the datagrams are played to this machine
+		wakeUp = 0
+		drone.REC = 0
+		main()
+	elif len(sys.argv) > 1 and sys.argv[1] == "tune":
+		tune([arg for arg in sys.argv[2:] if arg != "save"], "save" in sys.argv[2:])
+	elif len(sys.argv) > 1 and sys.argv[1] == "boards":
+		acquireBoards(boards)
+	else:
+		main()
\ No newline at end of file